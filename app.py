@@ -5,6 +5,7 @@ app = Flask(__name__)
 import config
 from models import models
 from controllers import routes
+from controllers import api
 
 
 
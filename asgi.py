@@ -0,0 +1,29 @@
+"""ASGI entry point: the quiz-taking API served by coroutines (controllers/async_api.py), and
+every other URL by the Flask app in a thread pool.
+
+    uvicorn asgi:application
+
+wsgi_application is the Flask app alone under the same server, for comparison.
+"""
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+from app import app
+from controllers.async_api import ROUTES
+from models.async_db import dispose_async_engine
+from models.ingest import score_queue
+
+wsgi_application = WSGIMiddleware(app, workers=app.config['WSGI_THREADS'])
+
+
+@asynccontextmanager
+async def lifespan(_):
+    score_queue()  # Replays journals left behind by stopped workers before serving
+    yield
+    await dispose_async_engine()
+
+
+application = Starlette(routes=[*ROUTES, Mount('/', app=wsgi_application)], lifespan=lifespan)
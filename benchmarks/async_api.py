@@ -0,0 +1,121 @@
+"""Throughput of the quiz-taking API with many concurrent connections: the synchronous Flask routes
+(in the server's thread pool) against the async routes of asgi.py, both under one uvicorn process.
+
+    python benchmarks/async_api.py [--users 10 50 200] [--rounds 5]
+
+Every simulated student loops over: fetch a quiz, submit answers, fetch the score. Needs uvicorn
+and httpx; the client shares the machine with the server, so compare the two rows of each user
+count rather than the absolute numbers.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from common import ROOT, load_app, seed
+
+# Label and the object in asgi.py that serves it
+TARGETS = [('sync', 'wsgi_application'), ('async', 'application')]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(target, port):
+    env = dict(os.environ, SCORE_JOURNAL_DIR=tempfile.mkdtemp(prefix='quizmaster-journal-'))
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'asgi:{target}', '--port', str(port),
+                               '--log-level', 'warning', '--no-access-log'], cwd=ROOT, env=env)
+    for _ in range(200):
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/login', timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'uvicorn did not start serving {target}')
+
+
+async def student(port, cookie, quiz_ids, question_ids, rounds, times, failures):
+    """One student on a connection of their own, with their session cookie."""
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', cookies={'session': cookie},
+                                 timeout=120) as client:
+        for i in range(rounds):
+            quiz_id = quiz_ids[i % len(quiz_ids)]
+            answers = {str(question_id): 2 for question_id in question_ids[quiz_id]}
+            requests = [('GET', f'/api/quizzes/{quiz_id}', None),
+                        ('POST', f'/api/quizzes/{quiz_id}/submit', {'answers': answers})]
+            for method, url, body in requests:
+                start = time.perf_counter()
+                response = await client.request(method, url, json=body)
+                times.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    failures.append(response.status_code)
+            ack_id = response.json().get('ack_id')
+            if ack_id:
+                start = time.perf_counter()
+                response = await client.get(f'/api/scores/{ack_id}')
+                times.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    failures.append(response.status_code)
+
+
+async def load(port, cookies, quiz_ids, question_ids, rounds):
+    times, failures = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[student(port, cookie, quiz_ids, question_ids, rounds, times, failures)
+                           for cookie in cookies])
+    return len(times) / (time.perf_counter() - start), times, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 50, 200], help='Concurrent students.')
+    parser.add_argument('--rounds', type=int, default=5, help='Quizzes each student takes.')
+    args = parser.parse_args()
+
+    app = load_app()
+    from models.models import db, User, Quiz, Question
+    with app.app_context():
+        seed(n_users=max(args.users), n_scores=10000)
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookies = [serializer.dumps({'user_id': row.id, 'role': 'user'})
+                   for row in db.session.query(User.id).order_by(User.id)]
+        quiz_ids = [row.id for row in db.session.query(Quiz.id).order_by(Quiz.id).limit(20)]
+        question_ids = {quiz_id: [row.id for row in db.session.query(Question.id).filter_by(quiz_id=quiz_id)]
+                        for quiz_id in quiz_ids}
+        db.engine.dispose()
+
+    ms = 1000
+    print(f'{"routes":8s} {"users":>6s} {"req/s":>8s} {"p50 ms":>8s} {"p99 ms":>8s} {"failures":>8s}', flush=True)
+    for label, target in TARGETS:
+        port = free_port()
+        server = start_server(target, port)
+        try:
+            for users in args.users:
+                throughput, times, failures = asyncio.run(load(port, cookies[:users], quiz_ids, question_ids,
+                                                               args.rounds))
+                print(f'{label:8s} {users:6d} {throughput:8.1f} {percentile(times, 0.5) * ms:8.1f} '
+                      f'{percentile(times, 0.99) * ms:8.1f} {len(failures):8d}', flush=True)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Shared setup for the benchmark scripts: a throwaway database with seeded data.
+
+SQLite in a temporary directory by default. Set BENCH_DATABASE_URI to run against another
+database, e.g. postgresql+psycopg://localhost/quizmaster_bench; its tables are dropped first.
+"""
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta, date, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(db_path=None):
+    """Imports the app against a scratch database so the real one is never touched."""
+    uri = os.environ.get('BENCH_DATABASE_URI')
+    if uri is None:
+        if db_path is None:
+            db_path = os.path.join(tempfile.mkdtemp(prefix='quizmaster-bench-'), 'bench.sqlite3')
+        uri = 'sqlite:///' + db_path
+    os.environ['SQLALCHEMY_DATABASE_URI'] = uri
+    sys.path.insert(0, ROOT)
+    from app import app
+    from models.models import db
+    with app.app_context():
+        if 'BENCH_DATABASE_URI' in os.environ:
+            db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
+    return app
+
+
+def seed(n_users=1000, n_subjects=10, chapters_per_subject=10, quizzes_per_chapter=5,
+         questions_per_quiz=10, n_scores=100000, seed_value=1):
+    """Bulk-inserts a synthetic catalogue and attempt history. Call inside an app context."""
+    from models.models import db, User, Subject, Chapter, Quiz, Question, Score, UserQuizStats, UserWeeklyStats
+    from models.leaderboard import rebuild_leaderboards
+
+    rnd = random.Random(seed_value)
+    db.session.execute(db.insert(User), [
+        {'username': f'user{i}', 'password_hash': 'x', 'full_name': f'User {i}',
+         'qualification': 'BSc', 'dob': datetime(2000, 1, 1), 'is_admin': False}
+        for i in range(n_users)
+    ])
+    db.session.execute(db.insert(Subject), [
+        {'name': f'Subject {i}', 'description': ''} for i in range(n_subjects)
+    ])
+    subject_ids = [row.id for row in db.session.query(Subject.id)]
+    db.session.execute(db.insert(Chapter), [
+        {'subject_id': subject_id, 'name': f'Chapter {subject_id}.{i}', 'description': ''}
+        for subject_id in subject_ids for i in range(chapters_per_subject)
+    ])
+    chapter_ids = [row.id for row in db.session.query(Chapter.id)]
+    db.session.execute(db.insert(Quiz), [
+        {'chapter_id': chapter_id, 'title': f'Quiz {chapter_id}.{i}', 'date_of_quiz': date(2024, 1, 1),
+         'time_duration': time(0, 30), 'remarks': '', 'question_count': questions_per_quiz}
+        for chapter_id in chapter_ids for i in range(quizzes_per_chapter)
+    ])
+    quiz_ids = [row.id for row in db.session.query(Quiz.id)]
+    db.session.execute(db.insert(Question), [
+        {'quiz_id': quiz_id, 'question_statement': f'Question {i}', 'option1': 'a', 'option2': 'b',
+         'option3': 'c', 'option4': 'd', 'correct_answer': 'b'}
+        for quiz_id in quiz_ids for i in range(questions_per_quiz)
+    ])
+    user_ids = [row.id for row in db.session.query(User.id)]
+    start = datetime(2024, 1, 1)
+    db.session.execute(db.insert(Score), [
+        {'quiz_id': rnd.choice(quiz_ids), 'user_id': rnd.choice(user_ids),
+         'time_stamp_of_attempt': start + timedelta(minutes=i),
+         'total_scored': rnd.randint(0, questions_per_quiz)}
+        for i in range(n_scores)
+    ])
+    db.session.commit()
+    Quiz.rebuild_counters()
+    UserQuizStats.rebuild()
+    UserWeeklyStats.rebuild()
+    rebuild_leaderboards()
@@ -0,0 +1,65 @@
+"""Shows the query plans and timings of the hot queries before and after the index migration.
+
+    python benchmarks/index_plans.py [--scores 100000]
+"""
+import argparse
+import time
+
+from common import load_app, seed
+
+HOT_QUERIES = {
+    'scoreboard (user attempts by date)':
+        'SELECT * FROM score WHERE user_id = :user_id ORDER BY time_stamp_of_attempt DESC',
+    'quiz top score':
+        'SELECT * FROM score WHERE quiz_id = :quiz_id ORDER BY total_scored DESC LIMIT 1',
+    'quiz attempts':
+        'SELECT count(*) FROM score WHERE quiz_id = :quiz_id',
+    'quiz questions':
+        'SELECT * FROM question WHERE quiz_id = :quiz_id',
+    'subject chapters':
+        'SELECT * FROM chapter WHERE subject_id = :subject_id',
+    'chapter quizzes':
+        'SELECT * FROM quiz WHERE chapter_id = :chapter_id',
+}
+PARAMS = {'user_id': 42, 'quiz_id': 7, 'subject_id': 3, 'chapter_id': 11}
+
+
+def report(db, label, repeat):
+    print(f'\n== {label} ==')
+    for name, sql in HOT_QUERIES.items():
+        explain = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        plan = db.session.execute(db.text(explain + sql), PARAMS).all()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            db.session.execute(db.text(sql), PARAMS).all()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        print(f'{name:40s} {elapsed:8.3f} ms   ' + ' | '.join(row[-1] for row in plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scores', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    app = load_app()
+    from models.models import db, Chapter, Quiz, Question, Score
+    from models.migrations import add_hot_path_indexes
+
+    with app.app_context():
+        # Start from the pre-migration schema: no secondary indexes
+        for model in (Chapter, Quiz, Question, Score):
+            for index in model.__table__.indexes:
+                index.drop(bind=db.engine, checkfirst=True)
+        seed(n_scores=args.scores)
+        db.session.execute(db.text('ANALYZE'))
+        report(db, 'before migration', args.repeat)
+
+        with db.engine.begin() as conn:
+            add_hot_path_indexes(conn)
+        db.session.execute(db.text('ANALYZE'))
+        report(db, 'after migration', args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Reports logins/sec through POST /login at each password hashing cost, with hashes verified
+in the request threads and in the worker pool.
+
+    python benchmarks/password_hashing.py [--logins 200] [--threads 8] [--workers 4]
+"""
+import argparse
+import threading
+import time
+
+from common import load_app
+
+COSTS = [
+    'pbkdf2:sha256:200000',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:1000000',
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+]
+
+
+def run_logins(app, username, logins, threads):
+    """Logs in `logins` times from `threads` concurrent clients. Returns (seconds, failures)."""
+    per_thread = [logins // threads + (1 if i < logins % threads else 0) for i in range(threads)]
+    failures = []
+
+    def worker(count):
+        client = app.test_client()
+        for _ in range(count):
+            response = client.post('/login', data={'username': username, 'password': 'secret'})
+            if response.status_code != 302 or not response.location.endswith('/user_dashboard'):
+                failures.append(response.status_code)
+
+    workers = [threading.Thread(target=worker, args=(count,)) for count in per_thread]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4, help='Size of the hashing process pool.')
+    args = parser.parse_args()
+
+    app = load_app()
+    from models.models import db, User
+    from models.passwords import hash_password
+
+    print(f'{args.logins} logins from {args.threads} threads')
+    print(f'{"cost":24s} {"hash ms":>8s} {"inline/s":>10s} {"pool/s":>10s}')
+    with app.app_context():
+        for i, method in enumerate(COSTS):
+            app.config['PASSWORD_HASH_METHOD'] = method
+            app.config['PASSWORD_WORKERS'] = 0
+            start = time.perf_counter()
+            password_hash = hash_password('secret')
+            hash_ms = (time.perf_counter() - start) * 1000
+            username = f'bench{i}'
+            db.session.add(User(username=username, password_hash=password_hash))
+            db.session.commit()
+
+            rates = []
+            for workers in (0, args.workers):
+                app.config['PASSWORD_WORKERS'] = workers
+                elapsed, failures = run_logins(app, username, args.logins, args.threads)
+                rates.append(f'{args.logins / elapsed:10.1f}' + (f' ({failures} failed)' if failures else ''))
+            print(f'{method:24s} {hash_ms:8.1f} {rates[0]} {rates[1]}')
+
+
+if __name__ == '__main__':
+    main()
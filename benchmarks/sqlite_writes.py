@@ -0,0 +1,145 @@
+"""Load test of concurrent score submissions under each SQLite engine profile, written directly or
+through the score queue: committed writes/sec, submit and read latency percentiles, and failed
+requests ("database is locked"), while other processes load leaderboards.
+
+    python benchmarks/sqlite_writes.py [--writers 8] [--readers 4] [--submissions 100]
+
+Writers and readers are separate processes, like the workers of a production server. Each profile
+runs against its own database, since the profile is applied when the engine is created.
+"""
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import load_app, seed
+
+# (engine profile, how scores are written)
+RUNS = [('default', 'direct'), ('tuned', 'direct'), ('tuned', 'queue')]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _writer(app, user_id, quiz_ids, question_ids, submissions, results):
+    client = client_for(app, user_id)
+    times, failures = [], 0
+    for i in range(submissions):
+        quiz_id = quiz_ids[(user_id + i) % len(quiz_ids)]
+        answers = {str(question_id): 2 for question_id in question_ids[quiz_id]}
+        start = time.perf_counter()
+        response = client.post(f'/api/quizzes/{quiz_id}/submit', json={'answers': answers})
+        if response.status_code in (201, 202):
+            times.append(time.perf_counter() - start)
+        else:
+            failures += 1  # 500: database is locked
+    # Queued scores count once they are committed
+    from models.ingest import score_queue
+    queue = score_queue()
+    if queue is not None:
+        queue.stop()
+    results.put(('write', times, failures))
+
+
+def _reader(app, user_id, quiz_ids, writing, results):
+    client = client_for(app, user_id)
+    times, failures, i = [], 0, 0
+    while writing.is_set():
+        start = time.perf_counter()
+        response = client.get(f'/api/leaderboards/quiz/{quiz_ids[i % len(quiz_ids)]}')
+        if response.status_code == 200:
+            times.append(time.perf_counter() - start)
+        else:
+            failures += 1
+        i += 1
+    results.put(('read', times, failures))
+
+
+def client_for(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['role'] = 'user'
+    return client
+
+
+def run_profile(args):
+    """Runs in the child process: seeds a database, then times writer and reader processes
+    (as under a multi-worker server) running together."""
+    app = load_app()
+    app.logger.disabled = True  # Failed requests are counted, not logged
+    from models.models import db, User, Quiz, Question
+
+    with app.app_context():
+        seed(n_users=args.writers + args.readers, n_scores=10000)
+        user_ids = [row.id for row in db.session.query(User.id).order_by(User.id)]
+        quiz_ids = [row.id for row in db.session.query(Quiz.id).order_by(Quiz.id).limit(20)]
+        question_ids = {quiz_id: [row.id for row in db.session.query(Question.id).filter_by(quiz_id=quiz_id)]
+                        for quiz_id in quiz_ids}
+        db.engine.dispose()  # Each process opens its own connections
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    writing = context.Event()
+    writing.set()
+    writers = [context.Process(target=_writer, args=(app, user_ids[n], quiz_ids, question_ids,
+                                                     args.submissions, results))
+               for n in range(args.writers)]
+    readers = [context.Process(target=_reader, args=(app, user_ids[args.writers + n], quiz_ids, writing, results))
+               for n in range(args.readers)]
+    start = time.perf_counter()
+    for process in writers + readers:
+        process.start()
+    collected = {'write': ([], 0), 'read': ([], 0)}
+    for _ in writers:
+        kind, times, failures = results.get()
+        collected[kind] = (collected[kind][0] + times, collected[kind][1] + failures)
+    elapsed = time.perf_counter() - start
+    writing.clear()
+    for _ in readers:
+        kind, times, failures = results.get()
+        collected[kind] = (collected[kind][0] + times, collected[kind][1] + failures)
+    for process in writers + readers:
+        process.join()
+
+    (write_times, write_failures), (read_times, read_failures) = collected['write'], collected['read']
+    ms = 1000
+    label = f'{app.config["SQLITE_PROFILE"]}/{app.config["SCORE_WRITES"]}'
+    print(f'{label:14s} {len(write_times) / elapsed:9.1f} '
+          f'{percentile(write_times, 0.5) * ms:9.1f} {percentile(write_times, 0.99) * ms:9.1f} '
+          f'{percentile(read_times, 0.5) * ms:9.1f} {percentile(read_times, 0.99) * ms:9.1f} '
+          f'{write_failures + read_failures:8d}', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--writers', type=int, default=8, help='Writer processes.')
+    parser.add_argument('--readers', type=int, default=4, help='Reader processes.')
+    parser.add_argument('--submissions', type=int, default=100, help='Scores submitted by each writer.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_profile(args)
+        return
+
+    print(f'{args.writers} writers x {args.submissions} submissions, {args.readers} leaderboard readers')
+    print(f'{"profile":14s} {"writes/s":>9s} {"w p50 ms":>9s} {"w p99 ms":>9s} {"r p50 ms":>9s} {"r p99 ms":>9s} '
+          f'{"failures":>8s}', flush=True)
+    for profile, writes in RUNS:
+        env = dict(os.environ, SQLITE_PROFILE=profile, SCORE_WRITES=writes,
+                   SCORE_JOURNAL_DIR=tempfile.mkdtemp(prefix='quizmaster-journal-'))
+        subprocess.run([sys.executable, __file__, '--child', '--writers', str(args.writers),
+                        '--readers', str(args.readers), '--submissions', str(args.submissions)],
+                       env=env, check=True)
+
+
+if __name__ == '__main__':
+    main()
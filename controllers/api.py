@@ -0,0 +1,172 @@
+from functools import wraps
+from flask import jsonify, request, session
+from app import app
+from models.models import db, Subject, Quiz, Question
+from models.grading import answer_key
+from models.leaderboard import leaderboard, attempt_total, percentile, user_best
+from models.ingest import record_score, score_queue, score_status
+from controllers.cache import fragment_cache
+from controllers.auth import current_user
+
+
+# JSON counterpart of login_required: answers 401 instead of redirecting to the login page
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user() is None:
+            return jsonify(error="You need to log in first!"), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def api_error(message, status=400):
+    return jsonify(error=message), status
+
+
+# QUIZ TAKING API
+@app.route('/api/quizzes/<int:quiz_id>')
+@api_login_required
+def api_quiz(quiz_id):
+    """Returns a quiz with all of its questions (without answers) in one response."""
+    quiz = db.session.get(Quiz, quiz_id)
+    if quiz is None:
+        return api_error("Quiz not found.", 404)
+
+    questions = Question.query.filter_by(quiz_id=quiz_id).order_by(Question.id).all()
+    return jsonify(quiz_payload(quiz, questions))
+
+
+def quiz_payload(quiz, questions):
+    """The JSON body of a quiz with its questions, shared with the async API."""
+    return dict(
+        id=quiz.id,
+        title=quiz.title,
+        date=quiz.date_of_quiz.isoformat() if quiz.date_of_quiz else None,
+        duration=quiz.time_duration.strftime('%H:%M') if quiz.time_duration else None,
+        questions=[{
+            'id': question.id,
+            'statement': question.question_statement,
+            'options': [
+                {'id': 1, 'text': question.option1},
+                {'id': 2, 'text': question.option2},
+                {'id': 3, 'text': question.option3},
+                {'id': 4, 'text': question.option4},
+            ],
+        } for question in questions]
+    )
+
+
+def parse_answers(submitted, key):
+    """Checks the submitted {"<question id>": <option id 1-4>} object against a quiz's answer key
+    and returns it as {question_id: option_id}, leaving out unanswered questions. Raises
+    ValueError with the message for the client."""
+    answers = {}
+    for question_id, option_id in submitted.items():
+        try:
+            question_id = int(question_id)
+        except ValueError:
+            raise ValueError(f"Invalid question id: {question_id}")
+        if question_id not in key:
+            raise ValueError(f"Question {question_id} is not part of this quiz.")
+        if option_id is None:
+            continue
+        if not isinstance(option_id, int) or isinstance(option_id, bool) or not 1 <= option_id <= 4:
+            raise ValueError(f"Invalid option for question {question_id}: {option_id}")
+        answers[question_id] = option_id
+    return answers
+
+
+@app.route('/api/quizzes/<int:quiz_id>/submit', methods=['POST'])
+@api_login_required
+def api_submit_quiz(quiz_id):
+    """Grades a whole attempt in one request and saves the score: 201 with its id, or when scores
+    are queued (SCORE_WRITES) 202 with the ack_id to look it up by.
+
+    Expects {"answers": {"<question id>": <option id 1-4>, ...}}; unanswered questions may be left out.
+    """
+    quiz = db.session.get(Quiz, quiz_id)
+    if quiz is None:
+        return api_error("Quiz not found.", 404)
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('answers'), dict):
+        return api_error("Expected a JSON object with an 'answers' object.")
+
+    key = answer_key(quiz_id, quiz.questions_version)
+    try:
+        answers = parse_answers(payload['answers'], key)
+    except ValueError as error:
+        return api_error(str(error))
+
+    total_marks = key.grade(answers)
+    result = dict(quiz_id=quiz_id, total_scored=total_marks, total_questions=len(key),
+                  questions_attempted=len(answers))
+
+    # Queued scores are acknowledged at once; GET /api/scores/<ack_id> tells when they are saved
+    queue = score_queue()
+    if queue is not None:
+        ack_id = queue.submit(quiz_id, session['user_id'], total_marks, answers)
+        return jsonify(ack_id=ack_id, status='pending', **result), 202
+
+    score = record_score(quiz_id, session['user_id'], total_marks, answers)
+    db.session.commit()
+    return jsonify(score_id=score.id, **result), 201
+
+
+@app.route('/api/scores/<ack_id>')
+@api_login_required
+def api_score_status(ack_id):
+    """Resolves the acknowledgement id of a submitted attempt: pending, saved (with its score id) or failed."""
+    status = score_status(ack_id, session['user_id'])
+    if status is None:
+        return api_error("Score not found.", 404)
+    return jsonify(ack_id=ack_id, status=status['state'], score_id=status['score_id'])
+
+
+# LEADERBOARD API
+@app.route('/api/leaderboards/<scope>/<int:scope_id>')
+@api_login_required
+def api_leaderboard(scope, scope_id):
+    """Returns the best and worst attempts of a quiz or subject, and the percentile of the user's best attempt.
+
+    Quiz boards rank by score, subject boards by percentage. ?limit= asks for fewer entries per side.
+    """
+    model = {'quiz': Quiz, 'subject': Subject}.get(scope)
+    if model is None:
+        return api_error("Unknown leaderboard; expected 'quiz' or 'subject'.", 404)
+    if db.session.get(model, scope_id) is None:
+        return api_error(f"{scope.capitalize()} not found.", 404)
+
+    limit = request.args.get('limit', type=int)
+
+    def entries(side):
+        return [{
+            'rank': rank,
+            'username': entry.user.username,
+            'total_scored': entry.total_scored,
+            'percentage': round(entry.value, 1) if scope == 'subject' else None,
+            'time_stamp_of_attempt': entry.time_stamp_of_attempt.isoformat() if entry.time_stamp_of_attempt else None,
+        } for rank, entry in enumerate(leaderboard(scope, scope_id, side, limit), start=1)]
+
+    best = user_best(scope, scope_id, session['user_id'])
+    return jsonify(
+        scope=scope,
+        id=scope_id,
+        attempts=attempt_total(scope, scope_id),
+        top=entries('top'),
+        bottom=entries('bottom'),
+        user={
+            'best': best,
+            'percentile': round(percentile(scope, scope_id, best), 1) if best is not None else None,
+        }
+    )
+
+
+# CACHE METRICS
+@app.route('/api/admin/cache')
+@api_login_required
+def api_cache_stats():
+    """Hit, miss and eviction counts and memory use of this worker's page fragment cache."""
+    if not current_user().is_admin:
+        return api_error("You are not authorized to view this page!", 403)
+    return jsonify(fragment_cache().stats())
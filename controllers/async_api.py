@@ -0,0 +1,125 @@
+import asyncio
+from functools import partial, wraps
+
+from itsdangerous import BadSignature
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app import app
+from models.models import db, Quiz, Question
+from models.async_db import async_session
+from models.grading import answer_key_async
+from models.ingest import score_queue, write_score, score_status_query, resolve_status
+from controllers.api import quiz_payload, parse_answers
+from controllers.auth import load_user_async
+
+# The quiz-taking API of controllers/api.py as coroutines, for asgi.py. Reads go through an
+# AsyncSession on the same models, so a request waiting on the database does not hold a worker
+# thread. Scores are written by the score queue's writer thread (or, with SCORE_WRITES=direct,
+# in a worker thread), since recording one shares its counter and leaderboard code with the
+# synchronous routes.
+
+
+def api_error(message, status=400):
+    return JSONResponse({'error': message}, status)
+
+
+def session_user_id(request):
+    """The user id in the request's Flask session cookie, or None."""
+    cookie = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        data = serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('user_id')
+
+
+# Opens the request's AsyncSession, passed to the endpoint, and answers 401 without a logged-in user
+def api_login_required(endpoint):
+    @wraps(endpoint)
+    async def decorated_endpoint(request):
+        async with async_session() as session:
+            user_id = session_user_id(request)
+            user = await load_user_async(session, user_id) if user_id is not None else None
+            if user is None:
+                return api_error("You need to log in first!", 401)
+            request.state.user = user
+            return await endpoint(request, session)
+    return decorated_endpoint
+
+
+@api_login_required
+async def api_quiz(request, session):
+    """GET /api/quizzes/<quiz_id>, as in controllers/api.py."""
+    quiz = await session.get(Quiz, request.path_params['quiz_id'])
+    if quiz is None:
+        return api_error("Quiz not found.", 404)
+    questions = (await session.scalars(
+        db.select(Question).where(Question.quiz_id == quiz.id).order_by(Question.id))).all()
+    return JSONResponse(quiz_payload(quiz, questions))
+
+
+@api_login_required
+async def api_submit_quiz(request, session):
+    """POST /api/quizzes/<quiz_id>/submit, as in controllers/api.py."""
+    quiz_id = request.path_params['quiz_id']
+    version = (await session.execute(db.select(Quiz.questions_version).where(Quiz.id == quiz_id))).scalar()
+    if version is None:
+        return api_error("Quiz not found.", 404)
+
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict) or not isinstance(payload.get('answers'), dict):
+        return api_error("Expected a JSON object with an 'answers' object.")
+
+    key = await answer_key_async(session, quiz_id, version)
+    try:
+        answers = parse_answers(payload['answers'], key)
+    except ValueError as error:
+        return api_error(str(error))
+
+    total_marks = key.grade(answers)
+    result = dict(quiz_id=quiz_id, total_scored=total_marks, total_questions=len(key),
+                  questions_attempted=len(answers))
+    user_id = request.state.user.id
+
+    queue = score_queue()
+    if queue is not None:
+        # A journal append; with SCORE_JOURNAL_FSYNC it waits on the disk, so off the event loop
+        submit = partial(queue.submit, quiz_id, user_id, total_marks, answers)
+        ack_id = await asyncio.to_thread(submit) if queue.fsync else submit()
+        return JSONResponse(dict(ack_id=ack_id, status='pending', **result), 202)
+
+    score_id = await asyncio.to_thread(write_score, quiz_id, user_id, total_marks, answers)
+    return JSONResponse(dict(score_id=score_id, **result), 201)
+
+
+@api_login_required
+async def api_score_status(request, session):
+    """GET /api/scores/<ack_id>, as in controllers/api.py."""
+    ack_id = request.path_params['ack_id']
+    user_id = request.state.user.id
+    score = (await session.execute(score_status_query(ack_id))).first()
+    if score is None:
+        # Looking through the journals reads files, so off the event loop
+        status = await asyncio.to_thread(resolve_status, None, ack_id, user_id)
+        if status is None:
+            # Committed by another worker since the first query, see resolve_status()
+            score = (await session.execute(score_status_query(ack_id))).first()
+    if score is not None:
+        status = resolve_status(score, ack_id, user_id)
+    if status is None:
+        return api_error("Score not found.", 404)
+    return JSONResponse({'ack_id': ack_id, 'status': status['state'], 'score_id': status['score_id']})
+
+
+ROUTES = [
+    Route('/api/quizzes/{quiz_id:int}', api_quiz),
+    Route('/api/quizzes/{quiz_id:int}/submit', api_submit_quiz, methods=['POST']),
+    Route('/api/scores/{ack_id}', api_score_status),
+]
@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import flash, g, redirect, session, url_for
+from sqlalchemy import event
+
+from app import app
+from models.models import db, User
+
+# What a request needs to know about its user. Records are shared between requests,
+# so they are plain tuples rather than ORM instances bound to one request's session.
+CurrentUser = namedtuple('CurrentUser', 'id username full_name is_admin')
+
+
+class UserCache:
+    """User records by id, each kept for ttl seconds, evicting the least recently used past max_size."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._users = OrderedDict()  # user id -> (loaded at, record)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            loaded_at, record = entry
+            if time.monotonic() - loaded_at > self.ttl:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+            return record
+
+    def set(self, record):
+        with self._lock:
+            self._users[record.id] = (time.monotonic(), record)
+            self._users.move_to_end(record.id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+
+_user_cache = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+
+# Changes made through the ORM drop the cached record at once; other worker processes
+# pick them up when their copy expires
+def _invalidate_user(mapper, conn, target):
+    _user_cache.invalidate(target.id)
+
+
+event.listen(User, 'after_update', _invalidate_user)
+event.listen(User, 'after_delete', _invalidate_user)
+
+
+def load_user(user_id):
+    """The record of a user, from the cache when it is fresh. None if there is no such user."""
+    record = _user_cache.get(user_id)
+    if record is None:
+        row = db.session.query(User.id, User.username, User.full_name, User.is_admin) \
+            .filter(User.id == user_id).first()
+        if row is None:
+            return None
+        record = CurrentUser(*row)
+        _user_cache.set(record)
+    return record
+
+
+async def load_user_async(session, user_id):
+    """load_user() for the async API: the same cache, queried through an AsyncSession."""
+    record = _user_cache.get(user_id)
+    if record is None:
+        row = (await session.execute(db.select(User.id, User.username, User.full_name, User.is_admin)
+                                     .where(User.id == user_id))).first()
+        if row is None:
+            return None
+        record = CurrentUser(*row)
+        _user_cache.set(record)
+    return record
+
+
+def role_of(user):
+    return 'admin' if user.is_admin else 'user'
+
+
+def current_user():
+    """The logged-in user's record, loaded at most once per request. None when logged out."""
+    if 'user' not in g:
+        user_id = session.get('user_id')
+        g.user = load_user(user_id) if user_id is not None else None
+        # Keep the role in the session in step with the account
+        if g.user is not None and session.get('role') != role_of(g.user):
+            session['role'] = role_of(g.user)
+    return g.user
+
+
+def login_user(user):
+    """Starts a session for a User that has just been authenticated."""
+    session['user_id'] = user.id
+    session['role'] = role_of(user)
+    g.user = CurrentUser(user.id, user.username, user.full_name, user.is_admin)
+    _user_cache.set(g.user)
+
+
+# Helper function to require login
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user() is None:
+            session.pop('user_id', None)  # The account may have been deleted
+            session.pop('role', None)
+            flash("You need to log in first!")
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# Like login_required, for pages only admins may see
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if not current_user().is_admin:
+            flash("You are not authorized to view this page!")
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,143 @@
+import sys
+import threading
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, Sequence
+
+from flask import current_app, g, request
+from markupsafe import Markup
+
+from models.models import CacheGeneration
+from controllers.auth import current_user, role_of
+
+
+def _sizeof(value):
+    """Rough memory footprint of a cached value, following lists, tuples, rows and dicts."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes)):
+        return size
+    if isinstance(value, Mapping):
+        return size + sum(_sizeof(key) + _sizeof(item) for key, item in value.items())
+    if isinstance(value, Sequence):
+        return size + sum(_sizeof(item) for item in value)
+    return size
+
+
+class FragmentCache:
+    """Rendered fragments and query results, least recently used first, within a memory budget.
+
+    Everything cached belongs to one content generation; seeing a newer one empties the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.generation = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = 0
+
+    def _drop(self, key):
+        _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def sync(self, generation):
+        with self._lock:
+            if self.generation is None or generation > self.generation:
+                self._entries.clear()
+                self._bytes = 0
+                self.generation = generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses[key[0]] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits[key[0]] += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = _sizeof(value)
+        with self._lock:
+            if key[-1] != self.generation or size > self.max_bytes:
+                return  # Built from content that has changed since, or too big to keep
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            names = sorted(set(self.hits) | set(self.misses))
+            return {
+                'generation': self.generation,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'evictions': self.evictions,
+                'fragments': {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in names},
+            }
+
+
+_fragment_cache = None
+_fragment_cache_lock = threading.Lock()
+
+
+def fragment_cache():
+    """The process-wide cache, sized by FRAGMENT_CACHE_BYTES."""
+    global _fragment_cache
+    with _fragment_cache_lock:
+        if _fragment_cache is None:
+            _fragment_cache = FragmentCache(current_app.config['FRAGMENT_CACHE_BYTES'])
+        return _fragment_cache
+
+
+def content_generation():
+    """The current content generation, read once per request.
+
+    It lives in the database so that a change made through one worker process is seen by all of them.
+    """
+    if 'content_generation' not in g:
+        g.content_generation = CacheGeneration.current()
+        fragment_cache().sync(g.content_generation)
+    return g.content_generation
+
+
+def content_changed():
+    """Invalidates every cached fragment once the current transaction commits; the caller commits."""
+    CacheGeneration.bump()
+
+
+def current_role():
+    user = current_user()
+    return role_of(user) if user else 'anonymous'
+
+
+def _cached(name, build, key):
+    cache = fragment_cache()
+    key = (name, current_role(), key, content_generation())
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value)
+    return value
+
+
+def cached_query(name, build, *key):
+    """Result of build() (plain rows or values) for this role and key, from the cache when the
+    content has not changed since."""
+    return _cached(name, build, key)
+
+
+def cached_fragment(name, build):
+    """HTML returned by build() for this role and URL, from the cache when the content has not
+    changed since. Keep per-user and flashed content out of fragments."""
+    return Markup(_cached(name, lambda: str(build()), request.full_path))
@@ -0,0 +1,164 @@
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app, request, Response
+from matplotlib.figure import Figure
+
+# Rendered images keyed by a hash of the chart spec, least recently used first
+_png_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def chart_spec(kind, labels, values, title, xlabel=None, ylabel=None,
+               color=None, figsize=(10, 6), rotation=None, ha=None):
+    """Describes a chart as plain data so it can be hashed and sent to a worker process."""
+    return {
+        'kind': kind,
+        'labels': list(labels),
+        'values': list(values),
+        'title': title,
+        'xlabel': xlabel,
+        'ylabel': ylabel,
+        'color': color,
+        'figsize': list(figsize),
+        'rotation': rotation,
+        'ha': ha,
+    }
+
+
+CHART_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+def draw_chart(spec, fmt='png'):
+    """Renders a chart spec to PNG (or SVG) bytes using the object-oriented Figure API."""
+    fig = Figure(figsize=spec['figsize'])
+    ax = fig.subplots()
+
+    if spec['kind'] == 'bar':
+        ax.bar(spec['labels'], spec['values'], color=spec['color'])
+    elif spec['kind'] == 'line':
+        ax.plot(spec['labels'], spec['values'], marker='o', linestyle='-')
+        ax.grid(True)
+    elif spec['kind'] == 'pie':
+        ax.pie(spec['values'], labels=spec['labels'], autopct='%1.1f%%', startangle=140)
+    else:
+        raise ValueError(f"Unknown chart kind: {spec['kind']}")
+
+    if spec['xlabel']:
+        ax.set_xlabel(spec['xlabel'])
+    if spec['ylabel']:
+        ax.set_ylabel(spec['ylabel'])
+    ax.set_title(spec['title'])
+    if spec['rotation']:
+        ax.tick_params(axis='x', labelrotation=spec['rotation'])
+    if spec['ha']:
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment(spec['ha'])
+    fig.tight_layout()
+
+    img = io.BytesIO()
+    fig.savefig(img, format=fmt)
+    return img.getvalue()
+
+
+def chart_key(spec, fmt='png'):
+    """Cache key for a chart spec; changes whenever the plotted data changes."""
+    payload = json.dumps(spec, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest() + '.' + fmt
+
+
+def _get_executor():
+    global _executor
+    workers = current_app.config.get('CHART_WORKERS', 0)
+    if not workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+
+def _cache_get(key):
+    with _cache_lock:
+        png = _png_cache.get(key)
+        if png is not None:
+            _png_cache.move_to_end(key)
+        return png
+
+
+def _cache_put(key, png):
+    max_size = current_app.config.get('CHART_CACHE_SIZE', 256)
+    with _cache_lock:
+        _png_cache[key] = png
+        _png_cache.move_to_end(key)
+        while len(_png_cache) > max_size:
+            _png_cache.popitem(last=False)
+
+
+def render_charts(*specs, fmt='png'):
+    """Returns image bytes for each spec, rendering cache misses in the worker pool."""
+    keys = [chart_key(spec, fmt) for spec in specs]
+    results = [_cache_get(key) for key in keys]
+
+    executor = _get_executor()
+    pending = {}
+    for i, (key, spec) in enumerate(zip(keys, specs)):
+        if results[i] is not None:
+            continue
+        if executor is not None:
+            pending[i] = executor.submit(draw_chart, spec, fmt)
+        else:
+            results[i] = draw_chart(spec, fmt)
+
+    for i, future in pending.items():
+        try:
+            results[i] = future.result()
+        except BrokenProcessPool:
+            # A worker died; drop the pool so the next call starts a fresh one
+            _reset_executor()
+            results[i] = draw_chart(specs[i], fmt)
+
+    for key, png in zip(keys, results):
+        _cache_put(key, png)
+    return results
+
+
+def render_chart(spec, fmt='png'):
+    """Returns image bytes for a single chart spec."""
+    return render_charts(spec, fmt=fmt)[0]
+
+
+def chart_response(spec, fmt='png'):
+    """Serves a chart with an ETag validator, answering conditional GETs with 304.
+
+    The ETag is the hash of the chart data, so a matching request is answered
+    before anything is rendered. There is no Last-Modified: a regrade or a rename
+    changes a chart without any newer attempt to date it by.
+    """
+    etag = chart_key(spec, fmt)
+    not_modified = request.if_none_match is not None and request.if_none_match.contains(etag)
+
+    response = Response(status=304) if not_modified else \
+        Response(render_chart(spec, fmt), mimetype=CHART_MIMETYPES[fmt])
+    response.set_etag(etag)
+    # Charts show per-user data: let the browser keep them but always revalidate
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
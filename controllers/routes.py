@@ -1,305 +1,241 @@
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from werkzeug.security import generate_password_hash, check_password_hash
-from models.models import db, User, Subject, Chapter, Quiz, Question, Score
-
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, Response, stream_with_context
+from models.models import db, User, Subject, Chapter, Quiz, Question, Score, UserQuizStats, UserWeeklyStats
+from models.analytics import subject_score_summary, analytics_reads
+from models.attempts import attempt_store
+from models.grading import grade, invalidate_answer_key, correct_option
+from models.regrade import start_regrade
+from models.search import search, SEARCHABLE
+from models.pagination import Page, keyset_paginate, page_size
+from models.leaderboard import leaderboard, top_values
+from models.ingest import submit_score, score_status
+from models.passwords import PasswordQueueFull
+from models.importer import import_stream, format_of, FORMATS
+from models.export import export_scores, MIMETYPES as EXPORT_MIMETYPES
+
+import io
 from datetime import datetime, timedelta, time
+from markupsafe import Markup
 from app import app
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend before importing pyplot
-import matplotlib.pyplot as plt
-import io  
-import base64  
-from sqlalchemy import or_
-from functools import wraps
-
-
-# Helper function to require login
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash("You need to log in first!")
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+from controllers.charts import chart_spec, chart_response, CHART_MIMETYPES
+from controllers.cache import cached_fragment, cached_query, content_changed
+from controllers.auth import current_user, login_user, login_required, admin_required
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
 
 # HOME/INDEX PAGE
 @app.route('/')
 @login_required
 def index():
-    user = User.query.get(session['user_id'])
-    if not user:
-        flash("User not found. Please log in again.")
-        session.clear()
-        return redirect(url_for('login'))
-
-    if user.is_admin:
+    if current_user().is_admin:
         return redirect(url_for('admin'))
     return render_template('index.html')  
 
 @app.route('/admin/search')
-@login_required
+@admin_required
 def admin_search():
-    user = User.query.get(session['user_id'])
-    if not user or not user.is_admin:
-        flash("You are not authorized to view this page!")
-        return redirect(url_for('index'))
-
     query = request.args.get('query', '')
     filter_type = request.args.get('filter', 'users')
+    page = request.args.get('page', 1, type=int)
 
-    if filter_type == 'users':
-        search_results = User.query.filter(
-            or_(User.username.ilike(f'%{query}%'),
-                User.full_name.ilike(f'%{query}%')),
-            User.is_admin == False  # Exclude admin users
-        ).all()
-    elif filter_type == 'subjects':
-        search_results = Subject.query.filter(Subject.name.ilike(f'%{query}%')).all()
-    elif filter_type == 'quizzes':
-        search_results = Quiz.query.filter(Quiz.title.ilike(f'%{query}%')).all()
+    # Ranked prefix search over the full-text index (admin users are never indexed).
+    # Results are ordered by relevance, not by a key, so they page by rank
+    if filter_type in SEARCHABLE:
+        results = search(filter_type, query, page=max(page, 1), per_page=page_size())
     else:
-        search_results = []
+        results = None
 
+    table, subjects = subjects_table()
     return render_template('admin_dashboard.html',
-                           search_results=search_results,
+                           search_results=results.items if results else [],
+                           search_page=results,
                            filter=filter_type,
-                           subjects=Subject.query.all(),
+                           subjects_table=table,
+                           subjects=subjects,
                            query=query)  
 
 @app.route('/admin/user/<int:user_id>')
-@login_required
+@admin_required
+@analytics_reads()
 def show_user(user_id):
     user = User.query.get_or_404(user_id)
-
-    # Calculate average scores per subject
-    subject_scores = {}
-    for score in Score.query.filter_by(user_id=user_id).all():
-        quiz = score.quiz
-        chapter = quiz.chapter
-        subject = chapter.subject
-        if subject.name not in subject_scores:
-            subject_scores[subject.name] = []
-        subject_scores[subject.name].append(score.total_scored)
-    
-    average_scores = {}
-    for subject, scores in subject_scores.items():
-        if scores:  # Ensure there are scores to average
-            average_scores[subject] = sum(scores) / len(scores)
-        else:
-            average_scores[subject] = 0  # Or some other default value
-
-    # Generate the chart
-    if average_scores:
-        plt.figure(figsize=(10, 6))
-        plt.bar(average_scores.keys(), average_scores.values())
-        plt.xlabel('Subject')
-        plt.ylabel('Average Score')
-        plt.title('Average Scores per Subject')
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-
-        # Convert plot to PNG image
-        img = io.BytesIO()
-        plt.savefig(img, format='png')
-        img.seek(0)
-        plt.close()
-        chart_image = base64.b64encode(img.read()).decode()
-    else:
-        chart_image = None
+    has_scores = Score.query.filter_by(user_id=user_id).first() is not None
 
     return render_template('search_user.html', 
                            user=user,
-                           chart_image=chart_image)
+                           chart_url=url_for('chart', kind='user-subjects', id=user_id, fmt='png') if has_scores else None)
+
+def generate_user_subjects_chart(user_id):
+    """Builds the average score per subject chart for one user."""
+    # Calculate average scores per subject from the user's per-quiz totals
+    rows = db.session.query(Subject.name, func.sum(UserQuizStats.score_sum), func.sum(UserQuizStats.attempt_count)) \
+        .join(Quiz, Quiz.id == UserQuizStats.quiz_id) \
+        .join(Chapter, Chapter.id == Quiz.chapter_id) \
+        .join(Subject, Subject.id == Chapter.subject_id) \
+        .filter(UserQuizStats.user_id == user_id) \
+        .group_by(Subject.id, Subject.name).order_by(Subject.id).all()
+    average_scores = {name: total / attempts for name, total, attempts in rows if attempts}
+
+    if not average_scores:
+        return None  # No data to plot
+
+    return chart_spec('bar', average_scores.keys(), average_scores.values(),
+                      'Average Scores per Subject', xlabel='Subject', ylabel='Average Score',
+                      rotation=45, ha='right')
+
+def subject_scores_query(subject_id):
+    """All scores for quizzes related to a subject."""
+    return Score.query.join(Quiz).join(Chapter).filter(Chapter.subject_id == subject_id)
 
 @app.route('/admin/subject/<int:subject_id>')
-@login_required
+@admin_required
+@analytics_reads()
 def show_subject(subject_id):
     subject = Subject.query.get_or_404(subject_id)
     num_chapters = Chapter.query.filter_by(subject_id=subject_id).count()
     num_quizzes = Quiz.query.join(Chapter).filter(Chapter.subject_id == subject_id).count()
-
-    # Get all scores for quizzes related to this subject
-    scores = Score.query.join(Quiz).join(Chapter).filter(Chapter.subject_id == subject_id).all()
-
-    # Calculate highest and lowest scores
-    if scores:
-        highest_score = max(scores, key=lambda score: score.total_scored)
-        lowest_score = min(scores, key=lambda score: score.total_scored)
-
-        highest_score_value = highest_score.total_scored
-        lowest_score_value = lowest_score.total_scored
-
-        # Generate the chart
-        plt.figure(figsize=(8, 6))
-        plt.bar(['Highest Score', 'Lowest Score'], [highest_score_value, lowest_score_value], color=['green', 'red'])
-        plt.ylabel('Score')
-        plt.title('Highest and Lowest Scores in Subject')
-        plt.xticks(['Highest Score', 'Lowest Score'])
-        plt.tight_layout()
-
-        # Convert plot to PNG image
-        img = io.BytesIO()
-        plt.savefig(img, format='png')
-        img.seek(0)
-        plt.close()
-        chart_image = base64.b64encode(img.read()).decode()
-    else:
-        highest_score_value = None
-        lowest_score_value = None
-        chart_image = None
+    has_scores = subject_scores_query(subject_id).first() is not None
 
     return render_template('search_subject.html',
                            subject=subject,
                            num_chapters=num_chapters,
                            num_quizzes=num_quizzes,
-                           chart_image=chart_image,
-                           highest_score_value=highest_score_value,
-                           lowest_score_value=lowest_score_value)
+                           top_entries=leaderboard('subject', subject_id, 'top', limit=5),
+                           bottom_entries=leaderboard('subject', subject_id, 'bottom', limit=5),
+                           chart_url=url_for('chart', kind='subject-scores', id=subject_id, fmt='png') if has_scores else None)
+
+def generate_subject_scores_chart(subject_id):
+    """Builds the highest and lowest score chart for a subject."""
+    # Highest and lowest scores come from the per-quiz counters
+    highest_score_value, lowest_score_value = db.session.query(func.max(Quiz.max_score), func.min(Quiz.min_score)) \
+        .join(Chapter).filter(Chapter.subject_id == subject_id).one()
+    if highest_score_value is None:
+        return None  # No data to plot
+
+    return chart_spec('bar', ['Highest Score', 'Lowest Score'], [highest_score_value, lowest_score_value],
+                      'Highest and Lowest Scores in Subject', ylabel='Score',
+                      color=['green', 'red'], figsize=(8, 6))
 
 @app.route('/admin/quiz/<int:quiz_id>')
-@login_required
+@admin_required
 def show_quiz(quiz_id):
     quiz = Quiz.query.get_or_404(quiz_id)
-    num_questions = Question.query.filter_by(quiz_id=quiz_id).count()
-
-    # Get all scores for this quiz
-    scores = Score.query.filter_by(quiz_id=quiz_id).all()
-
-    # Calculate highest and lowest scores
-    if scores:
-        highest_score = max(scores, key=lambda score: score.total_scored).total_scored
-        lowest_score = min(scores, key=lambda score: score.total_scored).total_scored
-        # Generate the chart
-        plt.figure(figsize=(6, 4))
-        plt.bar(['Highest Score', 'Lowest Score'], [highest_score, lowest_score], color=['green', 'red'])
-        plt.ylabel('Score')
-        plt.title('Highest and Lowest Scores in Quiz')
-        plt.xticks(['Highest Score', 'Lowest Score'])
-        plt.tight_layout()
-
-        # Convert plot to PNG image
-        img = io.BytesIO()
-        plt.savefig(img, format='png')
-        img.seek(0)
-        plt.close()
-        chart_image = base64.b64encode(img.read()).decode()
-    else:
-        highest_score = None
-        lowest_score = None
-        chart_image = None
 
     return render_template('search_quizzes.html',
                            quiz=quiz,
-                           num_questions=num_questions,
-                           chart_image=chart_image,
-                           highest_score=highest_score,
-                           lowest_score=lowest_score)
+                           num_questions=quiz.question_count,
+                           top_entries=leaderboard('quiz', quiz_id, 'top', limit=5),
+                           bottom_entries=leaderboard('quiz', quiz_id, 'bottom', limit=5),
+                           chart_url=url_for('chart', kind='quiz-scores', id=quiz_id, fmt='png') if quiz.attempt_count else None)
+
+def generate_quiz_scores_chart(quiz_id):
+    """Builds the highest and lowest score chart for a quiz."""
+    quiz = Quiz.query.get(quiz_id)
+    if not quiz or not quiz.attempt_count:
+        return None  # No data to plot
+
+    return chart_spec('bar', ['Highest Score', 'Lowest Score'], [quiz.max_score, quiz.min_score],
+                      'Highest and Lowest Scores in Quiz', ylabel='Score',
+                      color=['green', 'red'], figsize=(6, 4))
 
 @app.route('/admin/summary')
-@login_required
+@admin_required
+@analytics_reads()
 def admin_summary():
-    # Subject-wise Top Score Chart
-    subjects = Subject.query.all()
-    top_scores = {}
-    for subject in subjects:
-        # Find the quiz with the highest score in the subject
-        highest_score = Score.query.join(Quiz).join(Chapter).filter(Chapter.subject_id == subject.id).order_by(Score.total_scored.desc()).first()
-        if highest_score:
-            total_questions = len(highest_score.quiz.questions)
-            if total_questions > 0:
-                top_scores[subject.name] = (highest_score.total_scored / total_questions) * 100
-            else:
-                top_scores[subject.name] = 0
-        else:
-            top_scores[subject.name] = 0  # No scores available
-
-    plt.figure(figsize=(10, 6))
-    subject_names = list(top_scores.keys())
-    subject_scores = list(top_scores.values())
-    plt.bar(subject_names, subject_scores, color='skyblue')
-    plt.xlabel('Subject')
-    plt.ylabel('Top Score (%)')
-    plt.title('Subject-wise Top Score')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plt.close()
-    top_score_chart = base64.b64encode(img.read()).decode()
-
-    # Average Score in Each Subject Chart
-    average_scores = {}
-    for subject in subjects:
-        scores = Score.query.join(Quiz).join(Chapter).filter(Chapter.subject_id == subject.id).all()
-        if scores:
-            average_scores[subject.name] = sum(score.total_scored for score in scores) / len(scores)
-        else:
-            average_scores[subject.name] = 0
-
-    plt.figure(figsize=(10, 6))
-    subject_names = list(average_scores.keys())
-    subject_avg_scores = list(average_scores.values())
-    plt.bar(subject_names, subject_avg_scores, color='lightgreen')
-    plt.xlabel('Subject')
-    plt.ylabel('Average Score')
-    plt.title('Average Score in Each Subject')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plt.close()
-    average_score_chart = base64.b64encode(img.read()).decode()
-
-    # Percentage of Users Who Attempted Quizzes of Each Subject Chart
-    subject_user_counts = {}
-    total_users = User.query.count()
-    for subject in subjects:
-        # Count the number of unique users who have attempted quizzes in the subject
-        #user_count = Score.query.join(Quiz).join(Chapter).filter(Chapter.subject_id == subject.id).distinct(Score.user_id).count()
-        user_count = db.session.query(Score.user_id).join(Quiz).join(Chapter) \
-                .filter(Chapter.subject_id == subject.id) \
-                .distinct().count()
-
-        subject_user_counts[subject.name] = (user_count / total_users) * 100 if total_users > 0 else 0
-
-    plt.figure(figsize=(8, 6))
-    subject_names = list(subject_user_counts.keys())
-    user_percentages = list(subject_user_counts.values())
-    plt.pie(user_percentages, labels=subject_names, autopct='%1.1f%%', startangle=140)
-    plt.title('Percentage of Users Who Attempted Quizzes of Each Subject')
-    plt.tight_layout()
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plt.close()
-    users_attempted_chart = base64.b64encode(img.read()).decode()
-
     return render_template('admin_summary.html', 
-                           top_score_chart=top_score_chart,
-                           average_score_chart=average_score_chart,
-                           users_attempted_chart=users_attempted_chart)
+                           top_score_chart=url_for('chart', kind='top-score', fmt='png'),
+                           average_score_chart=url_for('chart', kind='average-score', fmt='png'),
+                           users_attempted_chart=url_for('chart', kind='users-attempted', fmt='png'),
+                           subjects=db.session.query(Subject.id, Subject.name).order_by(Subject.name).all())
+
+# Download of every score with its user, quiz, chapter and subject, streamed a chunk at a time
+@app.route('/admin/export/scores.<fmt>')
+@admin_required
+def export_scores_download(fmt):
+    if fmt not in EXPORT_MIMETYPES:
+        abort(404)
+    try:
+        start = User.parse_date(request.args['from']) if request.args.get('from') else None
+        end = User.parse_date(request.args['to']) if request.args.get('to') else None
+    except ValueError as error:
+        abort(400, str(error))
+    chunks = export_scores(fmt, start=start, end=end,
+                           subject_id=request.args.get('subject_id', type=int),
+                           quiz_id=request.args.get('quiz_id', type=int))
+    filename = f"scores-{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def generate_top_score_chart():
+    """Builds the subject-wise top score chart."""
+    # The best percentage of each subject is the head of its leaderboard
+    best = top_values('subject')
+    top_scores = {subject.name: best.get(subject.id, 0) for subject in Subject.query.order_by(Subject.id)}
+    return chart_spec('bar', top_scores.keys(), top_scores.values(), 'Subject-wise Top Score',
+                      xlabel='Subject', ylabel='Top Score (%)', color='skyblue',
+                      rotation=45, ha='right')
+
+def generate_average_score_chart():
+    """Builds the average score in each subject chart."""
+    average_scores = {row.name: row.avg_score or 0 for row in subject_score_summary()}
+    return chart_spec('bar', average_scores.keys(), average_scores.values(), 'Average Score in Each Subject',
+                      xlabel='Subject', ylabel='Average Score', color='lightgreen',
+                      rotation=45, ha='right')
+
+def generate_users_attempted_chart():
+    """Builds the percentage of users who attempted quizzes of each subject chart."""
+    total_users = User.query.count()
+    subject_user_counts = {row.name: (row.num_users / total_users) * 100 if total_users > 0 else 0
+                           for row in subject_score_summary()}
+    return chart_spec('pie', subject_user_counts.keys(), subject_user_counts.values(),
+                      'Percentage of Users Who Attempted Quizzes of Each Subject', figsize=(8, 6))
 
 # ADMIN DASHBOARD
+def subjects_table():
+    """One page of subjects for the admin dashboard, with the number of chapters of each: the
+    table's HTML and a Page without items for its pager.
+
+    The search page shows the same table under every query, so it is cached by page alone and
+    the pager, whose links keep the search, is rendered outside it.
+    """
+    def build():
+        subjects = keyset_paginate(Subject.query, [Subject.id])
+        ids = [subject.id for subject in subjects.items]
+        chapter_counts = dict(db.session.query(Chapter.subject_id, func.count(Chapter.id))
+                              .filter(Chapter.subject_id.in_(ids)).group_by(Chapter.subject_id).all())
+        return (render_template('subjects_table.html', subjects=subjects, chapter_counts=chapter_counts),
+                subjects.next_cursor, subjects.prev_cursor)
+    html, next_cursor, prev_cursor = cached_query('subjects-table', build, request.args.get('after'),
+                                                  request.args.get('before'), page_size())
+    return Markup(html), Page([], next_cursor, prev_cursor)
+
 @app.route('/admin')
-@login_required
+@admin_required
 def admin():
-    user = User.query.get(session['user_id'])
-    if not user:
-        flash("User not found. Please log in again.")
-        session.clear()
-        return redirect(url_for('login'))
-    
-    if not user.is_admin:
-        flash("You are not authorized to view this page!")
-        return render_template('index.html')
-    
-    # Fetch all subjects from the database
-    subjects = Subject.query.all()
-    return render_template('admin_dashboard.html', subjects=subjects)
+    # One page of subjects, rendered from the database only when the content has changed
+    table, subjects = subjects_table()
+    return render_template('admin_dashboard.html', subjects_table=table, subjects=subjects)
+
+# Bulk import of subjects, chapters, quizzes and questions from an uploaded file
+@app.route('/admin/import', methods=['GET', 'POST'])
+@admin_required
+def import_content():
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        fmt = request.form.get('format') or format_of(upload.filename if upload else None)
+        if not upload or not upload.filename:
+            flash("Choose a file to import.", "danger")
+        elif fmt not in FORMATS:
+            flash("Cannot tell the file's format from its name; choose one.", "danger")
+        else:
+            # Read straight from the upload, a batch at a time, whatever the file's size
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+            try:
+                report = import_stream(stream, fmt)
+            except UnicodeDecodeError:
+                flash("The file is not UTF-8 text; rows before the unreadable part may have been imported.", "danger")
+    return render_template('import.html', report=report, formats=FORMATS)
 
 # LOGIN GET AND POST ROUTES
 @app.route('/login')
@@ -320,12 +256,21 @@ def login_post():
     if not user:
         flash('User does not exist')
         return redirect(url_for('login'))
-    if not user.verify_password(password):
-        flash('Incorrect password')
-        return redirect(url_for('login'))
+    try:
+        if not user.verify_password(password):
+            flash('Incorrect password')
+            return redirect(url_for('login'))
+
+        # Upgrade hashes made with older settings while the plain password is at hand
+        if user.password_needs_rehash():
+            user.password = password
+            db.session.commit()
+    except PasswordQueueFull:
+        flash('Too many people are logging in right now. Please try again in a moment.')
+        return render_template('login.html'), 503
 
     flash('Login successful!')
-    session['user_id'] = user.id
+    login_user(user)
 
     # Redirect admin to admin dashboard, users to user dashboard
     if user.is_admin:
@@ -362,8 +307,12 @@ def register_post():
         flash("Invalid date format. Please use 'YYYY-MM-DD'.")
         return redirect(url_for('register'))
 
-    new_user = User(username=username, password=password, full_name=full_name,
-                        qualification=qualification, dob=dob)
+    try:
+        new_user = User(username=username, password=password, full_name=full_name,
+                            qualification=qualification, dob=dob)
+    except PasswordQueueFull:
+        flash('Too many people are signing up right now. Please try again in a moment.')
+        return render_template('register.html'), 503
     db.session.add(new_user)
     db.session.commit()
 
@@ -373,10 +322,12 @@ def register_post():
 
 #ALL SUBJECT RELATED ROUTES
 @app.route('/add_subject')
+@admin_required
 def add_subject():
     return render_template('add_subject.html')
 
 @app.route('/add_subject', methods=['POST'])
+@admin_required
 def add_subject_post():
     subject_name = request.form['name']
     subject_description = request.form['description']
@@ -389,12 +340,14 @@ def add_subject_post():
     # Create and add new subject to the database
     new_subject = Subject(name=subject_name, description=subject_description)
     db.session.add(new_subject)
+    content_changed()
     db.session.commit()
     
     flash('Subject added successfully!', 'success')
     return redirect(url_for('admin'))  
 
 @app.route('/edit_subject/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def edit_subject(id):
     # Fetch the subject by id
     subject = Subject.query.get_or_404(id)
@@ -410,6 +363,7 @@ def edit_subject(id):
             return redirect(url_for('edit_subject', id=id))
 
         # Commit the changes to the database
+        content_changed()
         db.session.commit()
         flash('Subject updated successfully!', 'success')
         return redirect(url_for('admin'))  # Redirect back to the admin dashboard
@@ -419,12 +373,14 @@ def edit_subject(id):
 
 
 @app.route('/delete_subject/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def delete_subject(id):
     # Fetch the subject by id
     subject = Subject.query.get_or_404(id)
     
     # Delete the subject from the database
     db.session.delete(subject)
+    content_changed()
     db.session.commit()
     
     flash('Subject deleted successfully!', 'success')
@@ -432,19 +388,26 @@ def delete_subject(id):
 
 
 @app.route('/show_chapters/<int:subject_id>', methods=['GET'])
+@admin_required
 def show_chapters(subject_id):
     # Fetch the subject by id
     subject = Subject.query.get_or_404(subject_id)
 
-    # Fetch the chapters related to this subject 
-    chapters = Chapter.query.filter_by(subject_id=subject.id).all()
+    # Fetch one page of the chapters related to this subject
+    def build():
+        chapters = keyset_paginate(Chapter.query.filter_by(subject_id=subject.id), [Chapter.id])
+        ids = [chapter.id for chapter in chapters.items]
+        quiz_counts = dict(db.session.query(Quiz.chapter_id, func.count(Quiz.id))
+                           .filter(Quiz.chapter_id.in_(ids)).group_by(Quiz.chapter_id).all())
+        return render_template('chapters_table.html', subject=subject, chapters=chapters, quiz_counts=quiz_counts)
 
-    return render_template('chapters.html', subject=subject, chapters=chapters)
+    return render_template('chapters.html', subject=subject, chapters_table=cached_fragment('chapters-table', build))
 
 
 #ROUTES FOR CHAPTERS WITHIN SUBJECTS
 
 @app.route('/add_chapter/<int:subject_id>', methods=['GET', 'POST'])
+@admin_required
 def add_chapter(subject_id):
     subject = Subject.query.get_or_404(subject_id)
 
@@ -458,6 +421,7 @@ def add_chapter(subject_id):
 
         new_chapter = Chapter(name=chapter_name, description=chapter_description, subject_id=subject.id)
         db.session.add(new_chapter)
+        content_changed()
         db.session.commit()
 
         flash('Chapter added successfully!', 'success')
@@ -467,6 +431,7 @@ def add_chapter(subject_id):
 
 
 @app.route('/edit_chapter/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def edit_chapter(id):
     # Fetch the chapter by id
     chapter = Chapter.query.get_or_404(id)
@@ -482,6 +447,7 @@ def edit_chapter(id):
             return redirect(url_for('edit_chapter', id=id))
 
         # Commit the changes to the database
+        content_changed()
         db.session.commit()
         flash('Chapter updated successfully!', 'success')
         return redirect(url_for('show_chapters', subject_id=chapter.subject_id))
@@ -492,11 +458,13 @@ def edit_chapter(id):
 
 
 @app.route('/delete_chapter/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def delete_chapter(id):
     chapter = Chapter.query.get_or_404(id)
     subject_id = chapter.subject_id  # Get the subject_id of the chapter
     
     db.session.delete(chapter)
+    content_changed()
     db.session.commit()
     
     flash('Chapter deleted successfully!', 'success')
@@ -507,18 +475,22 @@ def delete_chapter(id):
 
 
 @app.route('/show_quizzes/<int:id>', methods=['GET'])
+@admin_required
 def show_quizzes(id):
     # Fetch the chapter by id
     chapter = Chapter.query.get_or_404(id)
 
-    # Fetch quizzes related to this chapter
-    quizzes = Quiz.query.filter_by(chapter_id=chapter.id).all()
+    # Fetch one page of the quizzes related to this chapter
+    def build():
+        quizzes = keyset_paginate(Quiz.query.filter_by(chapter_id=chapter.id), [Quiz.id])
+        return render_template('quizzes_table.html', chapter=chapter, quizzes=quizzes)
 
-    return render_template('quizzes.html', chapter=chapter, quizzes=quizzes)
+    return render_template('quizzes.html', chapter=chapter, quizzes_table=cached_fragment('quizzes-table', build))
 
 #ROUTES FOR QUIZZES INSIDE EACH CHAPTER
 
 @app.route('/add_quiz/<int:chapter_id>', methods=['GET', 'POST'])
+@admin_required
 def add_quiz(chapter_id):
     # Fetch the chapter for which the quiz is being added
     chapter = Chapter.query.get_or_404(chapter_id)
@@ -556,6 +528,7 @@ def add_quiz(chapter_id):
 
         # Add the quiz to the database
         db.session.add(new_quiz)
+        content_changed()
         db.session.commit()
 
         # Flash success message and redirect to the quizzes page for the chapter
@@ -566,6 +539,7 @@ def add_quiz(chapter_id):
     return render_template('add_quiz.html', chapter=chapter)
 
 @app.route('/edit_quiz/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def edit_quiz(id):
     # Fetch the quiz to edit
     quiz = Quiz.query.get_or_404(id)
@@ -599,6 +573,7 @@ def edit_quiz(id):
         quiz.remarks = remarks
 
         # Save changes to the database
+        content_changed()
         db.session.commit()
 
         # Flash success message and redirect to the quizzes page for the chapter
@@ -610,12 +585,15 @@ def edit_quiz(id):
 
 
 @app.route('/delete_quiz/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def delete_quiz(id):
     quiz = Quiz.query.get_or_404(id)
     chapter_id = quiz.chapter_id  # Get the chapter_id of the quiz
 
     db.session.delete(quiz)
+    content_changed()
     db.session.commit()
+    invalidate_answer_key(id)
 
     flash('Quiz deleted successfully!', 'success')
 
@@ -625,13 +603,15 @@ def delete_quiz(id):
 
 # Show questions for a quiz
 @app.route('/quiz/<int:quiz_id>/questions')
+@admin_required
 def show_questions(quiz_id):
     quiz = Quiz.query.get_or_404(quiz_id)
-    questions = Question.query.filter_by(quiz_id=quiz_id).all()
+    questions = keyset_paginate(Question.query.filter_by(quiz_id=quiz_id), [Question.id])
     return render_template('questions.html', quiz_id=quiz.id, quiz_title=quiz.title, questions=questions)
 
 # Add a new question
 @app.route('/quiz/<int:quiz_id>/add_question', methods=['GET', 'POST'])
+@admin_required
 def add_question(quiz_id):
     quiz = Quiz.query.get_or_404(quiz_id)
     if request.method == 'POST':
@@ -653,18 +633,24 @@ def add_question(quiz_id):
         )
         
         db.session.add(new_question)
+        Quiz.change_question_count(quiz.id, 1)
+        content_changed()
         db.session.commit()
+        invalidate_answer_key(quiz.id)
         
         return redirect(url_for('show_questions', quiz_id=quiz.id))
     
     return render_template('add_questions.html', quiz_id=quiz.id, quiz_title=quiz.title)
 
 @app.route('/edit_question/<int:id>', methods=['GET', 'POST'])
+@admin_required
 def edit_question(id):
     # Fetch the question by ID
     question = Question.query.get_or_404(id)
     
     if request.method == 'POST':
+        previous_correct_option = correct_option(question)
+
         # Update question fields with form data
         question.question_statement = request.form['question_statement']
         question.option1 = request.form['option1']
@@ -672,10 +658,19 @@ def edit_question(id):
         question.option3 = request.form['option3']
         question.option4 = request.form['option4']
         question.correct_answer = request.form['correct_answer']
+        Quiz.questions_changed(question.quiz_id)
+        content_changed()
         
         # Save changes to the database
         db.session.commit()
-        flash('Question updated successfully!', 'success')
+        invalidate_answer_key(question.quiz_id)
+
+        # Existing attempts were graded against the old answer
+        if correct_option(question) != previous_correct_option:
+            start_regrade(question.quiz_id)
+            flash('Question updated successfully! Existing scores are being regraded.', 'success')
+        else:
+            flash('Question updated successfully!', 'success')
         return redirect(url_for('show_questions', quiz_id=question.quiz_id))
     
     # Render an edit form with the existing question details
@@ -684,6 +679,7 @@ def edit_question(id):
 
 
 @app.route('/delete_question/<int:id>', methods=['POST'])
+@admin_required
 def delete_question(id):
     # Fetch the question by ID
     question = Question.query.get_or_404(id)
@@ -693,7 +689,10 @@ def delete_question(id):
     
     # Delete the question
     db.session.delete(question)
+    Quiz.change_question_count(quiz_id, -1)
+    content_changed()
     db.session.commit()
+    invalidate_answer_key(quiz_id)
     flash('Question deleted successfully!', 'success')
     return redirect(url_for('show_questions', quiz_id=quiz_id))
 
@@ -701,21 +700,49 @@ def delete_question(id):
 @app.route('/user_dashboard')
 @login_required
 def user_dashboard():
-    # Fetch all quizzes
-    quizzes = Quiz.query.all()
-    
-    # Prepare quizzes with additional data (e.g., question count)
-    quiz_data = []
-    for quiz in quizzes:
-        quiz_data.append({
-            "id": quiz.id,
-            "title": quiz.title,
-            "num_questions": len(quiz.questions),
-            "date": quiz.date_of_quiz,
-            "duration": quiz.time_duration,
-        })
-    
-    return render_template('user_dashboard.html', quizzes=quiz_data)
+    subject_id = request.args.get('subject_id', type=int)
+    chapter_id = request.args.get('chapter_id', type=int)
+
+    # Fetch one page of quiz metadata; question counts are stored on the quiz
+    def build():
+        query = db.session.query(
+            Quiz.id,
+            Quiz.title,
+            Quiz.question_count,
+            Quiz.date_of_quiz,
+            Quiz.time_duration
+        )
+
+        if subject_id:
+            query = query.join(Chapter, Chapter.id == Quiz.chapter_id).filter(Chapter.subject_id == subject_id)
+        if chapter_id:
+            query = query.filter(Quiz.chapter_id == chapter_id)
+
+        pagination = keyset_paginate(query, [Quiz.id])
+
+        quiz_data = []
+        for quiz in pagination.items:
+            quiz_data.append({
+                "id": quiz.id,
+                "title": quiz.title,
+                "num_questions": quiz.question_count,
+                "date": quiz.date_of_quiz,
+                "duration": quiz.time_duration,
+            })
+        return render_template('dashboard_quizzes.html', quizzes=quiz_data, pagination=pagination,
+                               subject_id=subject_id, chapter_id=chapter_id)
+
+    # Options for the subject and chapter filters
+    subjects = cached_query('subject-options',
+                            lambda: db.session.query(Subject.id, Subject.name).order_by(Subject.name).all())
+    chapters = cached_query('chapter-options',
+                            lambda: db.session.query(Chapter.id, Chapter.name).filter_by(subject_id=subject_id)
+                            .order_by(Chapter.name).all(),
+                            subject_id) if subject_id else []
+
+    return render_template('user_dashboard.html', quizzes_table=cached_fragment('dashboard-quizzes', build),
+                           subjects=subjects, chapters=chapters,
+                           subject_id=subject_id, chapter_id=chapter_id)
 
 @app.route('/quiz/<int:quiz_id>/view')
 @login_required
@@ -724,240 +751,206 @@ def view_quiz(quiz_id):
     quiz = Quiz.query.get_or_404(quiz_id)
     return render_template('view_quiz.html', quiz=quiz)
 
-@app.route('/start_quiz/<int:quiz_id>', methods=['GET', 'POST'])
-@login_required
-def start_quiz(quiz_id):
-    quiz = Quiz.query.get_or_404(quiz_id)
-    questions = quiz.questions  # This is already a list of all questions
-
-    # Initialize quiz data in session if it's a new attempt
-    if 'quiz_data' not in session or session['quiz_data'].get('quiz_id') != quiz_id:
-        session['quiz_data'] = {
-            'quiz_id': quiz_id,
-            'current_question_index': 0,
-            'total_marks': 0,
-            'answers': {},
-            'total_questions': len(questions),
-            'questions_attempted': 0
-        }
-    
-    quiz_data = session['quiz_data']
-    current_question_index = int(quiz_data['current_question_index'])
-    total_questions = int(quiz_data['total_questions'])
-
-    if current_question_index >= total_questions:
-        # Quiz finished - redirect to scores
-        return redirect(url_for('save_score', quiz_id=quiz_id)) #redirecting to save_score
-
-    question = questions[current_question_index]
-    options = [
+def question_options(question):
+    return [
         {'id': 1, 'text': question.option1},
         {'id': 2, 'text': question.option2},
         {'id': 3, 'text': question.option3},
         {'id': 4, 'text': question.option4},
     ]
 
-    selected_option = None
+def current_attempt(quiz):
+    """Returns the user's in-progress attempt at a quiz, resuming an open one or starting a new one."""
+    store = attempt_store()
+    user_id = session['user_id']
+    attempt = store.get(session.get('attempt_id'))
+    if not attempt or attempt['quiz_id'] != quiz.id or attempt['user_id'] != user_id:
+        # Resume an attempt started elsewhere (another tab or device) before starting afresh
+        attempt = store.find_open(user_id, quiz.id) or store.start(user_id, quiz.id, quiz.question_count)
+        session['attempt_id'] = attempt['id']  # The cookie only carries the attempt id
+    return attempt
+
+@app.route('/start_quiz/<int:quiz_id>', methods=['GET', 'POST'])
+@login_required
+def start_quiz(quiz_id):
+    quiz = Quiz.query.get_or_404(quiz_id)
+    attempt = current_attempt(quiz)
+    current_question_index = attempt['current_question_index']
+    total_questions = attempt['total_questions']
+
+    # Load only the question being shown
+    question = None
+    if current_question_index < total_questions:
+        question = Question.query.filter_by(quiz_id=quiz_id).order_by(Question.id) \
+            .offset(current_question_index).first()
+    if question is None:
+        # Quiz finished - redirect to scores
+        return redirect(url_for('save_score', quiz_id=quiz_id)) #redirecting to save_score
 
     if request.method == 'POST':
-        selected_option_id = request.form.get('selected_option')
+        selected_option_id = request.form.get('selected_option', type=int)
         action = request.form.get('action')
 
+        if selected_option_id is not None and not 1 <= selected_option_id <= 4:
+            flash('Invalid option selected.', 'error')
+            return redirect(url_for('start_quiz', quiz_id=quiz_id))
         if selected_option_id:
-            selected_option_id = int(selected_option_id)
-            quiz_data['questions_attempted'] = int(quiz_data['questions_attempted']) + 1
-
-            # Store the answer in the session
-            quiz_data['answers'][str(question.id)] = selected_option_id
-
-            # Check if the answer is correct
-            correct_option_text = question.correct_answer
-            selected_option_text = next((option['text'] for option in options if option['id'] == selected_option_id), None)
-
-            if selected_option_text == correct_option_text:
-                quiz_data['total_marks'] = int(quiz_data['total_marks']) + 1
+            # Store the answer as soon as it is given
+            attempt_store().save_answer(attempt['id'], question.id, selected_option_id)
 
         if action == 'save_next':
-            quiz_data['current_question_index'] = int(quiz_data['current_question_index']) + 1
-            session['quiz_data'] = quiz_data  # Update session
+            attempt_store().advance(attempt['id'], current_question_index + 1)
             return redirect(url_for('start_quiz', quiz_id=quiz_id))
         elif action == 'submit':
-            session['quiz_data'] = quiz_data  # Ensure data is updated
             return redirect(url_for('save_score', quiz_id=quiz_id)) #redirection to save_score
 
     # If it's a GET request or no option was selected in POST, display the question
-    # Check if there's a previously selected option for this question
-    if str(question.id) in quiz_data['answers']:
-        selected_option = quiz_data['answers'][str(question.id)]
-
-    # Ensure all values in quiz_data are of consistent types
-    quiz_data['current_question_index'] = int(quiz_data['current_question_index'])
-    quiz_data['total_marks'] = int(quiz_data['total_marks'])
-    quiz_data['total_questions'] = int(quiz_data['total_questions'])
-    quiz_data['questions_attempted'] = int(quiz_data['questions_attempted'])
-
-    session['quiz_data'] = quiz_data  # Update session with consistent data types
-
-    # Debug: Print session data
-    print("Session quiz_data:", session['quiz_data'])
-
+    # with any previously selected option
     return render_template(
         'start_quiz.html',
         quiz=quiz,
         question=question,
-        options=options,
-        current_question_index=current_question_index,  # Corrected: Use current_question_index directly
+        options=question_options(question),
+        current_question_index=current_question_index,
         total_questions=total_questions,
-        selected_option=selected_option
+        selected_option=attempt['answers'].get(question.id)
     )
 
 @app.route('/save_score/<int:quiz_id>') #saving score
 @login_required
 def save_score(quiz_id):
     quiz = Quiz.query.get_or_404(quiz_id)  # Retrieve the quiz from the database
-    quiz_data = session.get('quiz_data')
-
-    if quiz_data and quiz_data.get('quiz_id') == quiz_id:
-        total_questions = quiz_data['total_questions']
-        total_marks = quiz_data['total_marks']
-
-        # Create a new Score record in the database
-        score = Score(
-            quiz_id=quiz_id,
-            user_id=session['user_id'],
-            time_stamp_of_attempt=datetime.now(),
-            total_scored=total_marks
-        )
-        db.session.add(score)
+    attempt = attempt_store().get(session.get('attempt_id'))
+
+    if attempt and attempt['quiz_id'] == quiz_id and attempt['user_id'] == session['user_id']:
+        total_marks = grade(quiz_id, attempt['answers'], quiz.questions_version)
+
+        # Queue the score (or write it at once when SCORE_WRITES is 'direct')
+        ack_id = submit_score(quiz_id, session['user_id'], total_marks, attempt['answers'])
+        attempt_store().finish(attempt['id'])
         db.session.commit()
 
-        session.pop('quiz_data', None)  # Clear quiz data after saving score
+        session.pop('attempt_id', None)  # Clear the attempt after saving score
+        if ack_id:
+            return redirect(url_for('scoreboard', ack=ack_id))
     return redirect(url_for('scoreboard')) #redirecting to scoreboard
 
 @app.route('/scoreboard')
 @login_required
 def scoreboard():
     user_id = session['user_id']
-    scores = Score.query.filter_by(user_id=user_id).order_by(Score.time_stamp_of_attempt.desc()).all()
-    return render_template('scores.html', scores=scores)
+    # Newest first, one page at a time; the quiz of each score comes in the same query
+    scores = keyset_paginate(Score.query.filter_by(user_id=user_id).options(joinedload(Score.quiz)),
+                             [Score.time_stamp_of_attempt, Score.id], descending=True)
+    # A score just submitted may still be in the queue
+    submitted = score_status(request.args['ack'], user_id) if request.args.get('ack') else None
+    submitted_quiz = db.session.get(Quiz, submitted['quiz_id']) if submitted and submitted['quiz_id'] else None
+    return render_template('scores.html', scores=scores, submitted=submitted, submitted_quiz=submitted_quiz)
 
 def generate_score_trend_chart(user_id):
-    """Generates a score trend line chart using Matplotlib."""
-    scores = Score.query.filter_by(user_id=user_id).order_by(Score.time_stamp_of_attempt).all()
-    if not scores:
+    """Builds the score trend line chart for one user: the average score of each week."""
+    weeks = UserWeeklyStats.query.filter_by(user_id=user_id).order_by(UserWeeklyStats.week).all()
+    if not weeks:
         return None  # No data to plot
 
-    dates = [score.time_stamp_of_attempt for score in scores]
-    marks = [score.total_scored for score in scores]
-
-    plt.figure(figsize=(8, 4))  
-    plt.plot(dates, marks, marker='o', linestyle='-')
-    plt.xlabel('Date')
-    plt.ylabel('Score')
-    plt.title('Score Trend Over Time')
-    plt.grid(True)
-    plt.xticks(rotation=45)  # Rotate x-axis labels for better readability
-    plt.tight_layout()  # Adjust layout to prevent labels from overlapping
-
-    # Save to a BytesIO object and encode to base64
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plt.close()  # Close the plot to free memory
-    return base64.b64encode(img.read()).decode()
+    labels = [week.week for week in weeks]
+    averages = [week.average_score for week in weeks]
+
+    # Rotate x-axis labels for better readability
+    return chart_spec('line', labels, averages, 'Score Trend Over Time',
+                      xlabel='Week (Year-Week)', ylabel='Average Score', figsize=(8, 4), rotation=45)
 
 def generate_average_score_bar_chart(user_id):
-    """Generates an average score bar chart using Matplotlib."""
-    # Fetch all scores for the user
-    scores = Score.query.filter_by(user_id=user_id).all()
+    """Builds the average score per quiz bar chart for one user."""
+    # The user's totals for each quiz, with the quiz titles, in one query
+    rows = db.session.query(Quiz.title, UserQuizStats.score_sum, UserQuizStats.attempt_count) \
+        .join(Quiz, Quiz.id == UserQuizStats.quiz_id) \
+        .filter(UserQuizStats.user_id == user_id).order_by(Quiz.id).all()
 
-    if not scores:
+    if not rows:
         return None  # No data to plot
 
-    # Group scores by quiz ID
-    quiz_scores = {}
-    for score in scores:
-        if score.quiz_id not in quiz_scores:
-            quiz_scores[score.quiz_id] = []
-        quiz_scores[score.quiz_id].append(score.total_scored)
-
-    # Calculate average score for each quiz
-    quiz_averages = {quiz_id: sum(scores) / len(scores) for quiz_id, scores in quiz_scores.items()}
-
-    # Get quiz titles for labels
-    quiz_titles = {quiz_id: Quiz.query.get(quiz_id).title for quiz_id in quiz_averages}
-
     # Prepare data for plotting
-    quiz_ids = list(quiz_averages.keys())
-    averages = list(quiz_averages.values())
-    labels = [quiz_titles[quiz_id] for quiz_id in quiz_ids]
-
-    # Create the bar chart
-    plt.figure(figsize=(10, 6))
-    plt.bar(labels, averages, color='skyblue')
-    plt.xlabel('Quiz')
-    plt.ylabel('Average Score')
-    plt.title('Average Score per Quiz')
-    plt.xticks(rotation=45, ha='right')  # Rotate labels for readability
-    plt.tight_layout()
-
-    # Convert plot to PNG image
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plt.close()
-    return base64.b64encode(img.read()).decode()
+    labels = [row.title for row in rows]
+    averages = [row.score_sum / row.attempt_count for row in rows]
+
+    # Create the bar chart, rotating labels for readability
+    return chart_spec('bar', labels, averages, 'Average Score per Quiz',
+                      xlabel='Quiz', ylabel='Average Score', color='skyblue',
+                      rotation=45, ha='right')
 
 def generate_quizzes_attempted_chart(user_id):
-    """Generates a quizzes attempted bar chart using Matplotlib."""
-    # Fetch all scores for the user
-    scores = Score.query.filter_by(user_id=user_id).all()
+    """Builds the quizzes attempted per week bar chart for one user."""
+    # Weekly buckets kept up to date as scores are saved
+    rows = UserWeeklyStats.query.filter_by(user_id=user_id).order_by(UserWeeklyStats.week).all()
 
-    if not scores:
+    if not rows:
         return None  # No data to plot
 
-    # Group scores by week/month
-    weekly_attempts = {}
-    for score in scores:
-        week = score.time_stamp_of_attempt.strftime('%Y-%W')  # Year-Week format
-        if week not in weekly_attempts:
-            weekly_attempts[week] = 0
-        weekly_attempts[week] += 1
-
     # Prepare data for plotting
-    weeks = list(weekly_attempts.keys())
-    attempts = list(weekly_attempts.values())
-
-    # Create the bar chart
-    plt.figure(figsize=(10, 6))
-    plt.bar(weeks, attempts, color='lightgreen')
-    plt.xlabel('Week (Year-Week)')
-    plt.ylabel('Number of Quizzes Attempted')
-    plt.title('Quizzes Attempted per Week')
-    plt.xticks(rotation=45, ha='right')  # Rotate labels for readability
-    plt.tight_layout()
-
-    # Convert plot to PNG image
-    img = io.BytesIO()
-    plt.savefig(img, format='png')
-    img.seek(0)
-    plt.close()
-    return base64.b64encode(img.read()).decode()
+    weeks = [row.week for row in rows]
+    attempts = [row.attempt_count for row in rows]
+
+    # Create the bar chart, rotating labels for readability
+    return chart_spec('bar', weeks, attempts, 'Quizzes Attempted per Week',
+                      xlabel='Week (Year-Week)', ylabel='Number of Quizzes Attempted',
+                      color='lightgreen', rotation=45, ha='right')
 
 @app.route('/user_summary')
 @login_required
+@analytics_reads()
 def user_summary():
     user_id = session['user_id']
+    # Per-quiz totals maintained as scores are saved, with their quizzes, in one query
+    quiz_stats = UserQuizStats.query.filter_by(user_id=user_id).join(UserQuizStats.quiz) \
+        .options(db.contains_eager(UserQuizStats.quiz)).order_by(UserQuizStats.last_attempt_at.desc()).all()
+    has_scores = bool(quiz_stats)
 
-    # Generate charts
-    score_trend_chart = generate_score_trend_chart(user_id)
-    average_score_chart = generate_average_score_bar_chart(user_id)
-    quizzes_attempted_chart = generate_quizzes_attempted_chart(user_id)
+    # Charts are served separately so the browser can cache them
+    def chart_url(kind):
+        return url_for('chart', kind=kind, id=user_id, fmt='png') if has_scores else None
 
     return render_template(
         'user_summary.html',
-        score_trend_chart=score_trend_chart,
-        average_score_chart=average_score_chart,
-        quizzes_attempted_chart=quizzes_attempted_chart
+        quiz_stats=quiz_stats,
+        total_attempts=sum(stats.attempt_count for stats in quiz_stats),
+        score_trend_chart=chart_url('score-trend'),
+        average_score_chart=chart_url('quiz-averages'),
+        quizzes_attempted_chart=chart_url('weekly-attempts')
     )
 
+#CHART IMAGES
+# kind -> (chart builder, whether its URL carries an id, whether a user may view charts for their own id)
+CHARTS = {
+    'user-subjects': (generate_user_subjects_chart, True, True),
+    'subject-scores': (generate_subject_scores_chart, True, False),
+    'quiz-scores': (generate_quiz_scores_chart, True, False),
+    'top-score': (generate_top_score_chart, False, False),
+    'average-score': (generate_average_score_chart, False, False),
+    'users-attempted': (generate_users_attempted_chart, False, False),
+    'score-trend': (generate_score_trend_chart, True, True),
+    'quiz-averages': (generate_average_score_bar_chart, True, True),
+    'weekly-attempts': (generate_quizzes_attempted_chart, True, True),
+}
+
+@app.route('/charts/<kind>.<fmt>', defaults={'id': None})
+@app.route('/charts/<kind>/<int:id>.<fmt>')
+@login_required
+@analytics_reads()
+def chart(kind, id, fmt):
+    if kind not in CHARTS or fmt not in CHART_MIMETYPES:
+        abort(404)
+    build_chart, takes_id, own_charts_allowed = CHARTS[kind]
+    if takes_id != (id is not None):
+        abort(404)
+
+    user = current_user()
+    if not (user.is_admin or (own_charts_allowed and id == user.id)):
+        abort(403)
+
+    args = () if id is None else (id,)
+    spec = build_chart(*args)
+    if spec is None:
+        abort(404)
+    return chart_response(spec, fmt)
+
@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+
+from sqlalchemy import func
+from models.models import db, Subject, Chapter, Quiz, Score
+
+
+@contextmanager
+def analytics_reads():
+    """Sends the queries db.session runs in the block to the read-only analytics engine.
+
+    Also a view decorator: @analytics_reads(). Writes still go to the primary, and reads may lag
+    it by whatever the replica lags (nothing for a second SQLite connection).
+    """
+    info = db.session.info
+    previous = info.get('analytics_reads', False)
+    info['analytics_reads'] = True
+    try:
+        yield
+    finally:
+        info['analytics_reads'] = previous
+
+
+def subject_score_summary():
+    """Computes the score metrics of every subject in a single grouped query.
+
+    Each row has: id, name, max_score, top_percentage, avg_score, num_attempts
+    and num_users. Subjects without attempts are included with NULL metrics.
+    """
+    percentage = Score.total_scored * 100.0 / func.nullif(Quiz.question_count, 0)
+
+    return db.session.query(
+        Subject.id,
+        Subject.name,
+        func.max(Score.total_scored).label('max_score'),
+        func.max(percentage).label('top_percentage'),
+        db.cast(func.avg(Score.total_scored), db.Float).label('avg_score'),  # PostgreSQL averages as numeric
+        func.count(Score.id).label('num_attempts'),
+        func.count(func.distinct(Score.user_id)).label('num_users')
+    ).select_from(Subject) \
+        .outerjoin(Chapter, Chapter.subject_id == Subject.id) \
+        .outerjoin(Quiz, Quiz.chapter_id == Chapter.id) \
+        .outerjoin(Score, Score.quiz_id == Quiz.id) \
+        .group_by(Subject.id, Subject.name) \
+        .order_by(Subject.id) \
+        .all()
@@ -0,0 +1,43 @@
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import app
+from models.models import db
+from models.engine import engine_options, sqlite_pragmas, install_pragmas
+
+# Driver the async engine uses for each database, unless ASYNC_DATABASE_URI says otherwise
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'psycopg'}
+
+_engine = None
+_sessions = None
+
+
+def async_uri():
+    """ASYNC_DATABASE_URI, or the primary database (as Flask-SQLAlchemy resolved its path) with
+    the async driver of its dialect."""
+    if app.config.get('ASYNC_DATABASE_URI'):
+        return app.config['ASYNC_DATABASE_URI']
+    with app.app_context():
+        url = db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'No async driver known for {backend}; set ASYNC_DATABASE_URI')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+def async_session():
+    """A new AsyncSession on this process's async engine, which is created on first use with the
+    same pool size and SQLite pragmas as the primary. Use it as `async with async_session() as session`."""
+    global _engine, _sessions
+    if _engine is None:
+        _engine = create_async_engine(async_uri(), **engine_options(app.config))
+        install_pragmas(_engine.sync_engine, sqlite_pragmas(app.config))
+        _sessions = async_sessionmaker(_engine, expire_on_commit=False)
+    return _sessions()
+
+
+async def dispose_async_engine():
+    """Closes the async engine's connections; the next async_session() opens a new engine."""
+    global _engine, _sessions
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = _sessions = None
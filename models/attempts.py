@@ -0,0 +1,189 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app import app
+from models.models import db, QuizAttempt, AttemptAnswer
+from models.dialects import upsert
+
+# Attempt state shared by every store:
+#   {'id', 'user_id', 'quiz_id', 'current_question_index', 'total_questions', 'answers': {question_id: option}}
+
+
+def new_attempt(user_id, quiz_id, total_questions):
+    return {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'quiz_id': quiz_id,
+        'current_question_index': 0,
+        'total_questions': total_questions,
+        'answers': {},
+    }
+
+
+class MemoryAttemptStore:
+    """Keeps attempts in process memory, evicting the least recently used and those idle past the TTL.
+
+    Attempts only survive as long as the worker process, so use it with a single worker.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._attempts = OrderedDict()  # attempt id -> (last used, attempt)
+        self._open = {}  # (user_id, quiz_id) -> attempt id
+        self._lock = threading.Lock()
+
+    def _touch(self, attempt):
+        self._attempts[attempt['id']] = (time.monotonic(), attempt)
+        self._attempts.move_to_end(attempt['id'])
+        self._open[(attempt['user_id'], attempt['quiz_id'])] = attempt['id']
+        while len(self._attempts) > self.max_size:
+            _, (_, evicted) = self._attempts.popitem(last=False)
+            self._open.pop((evicted['user_id'], evicted['quiz_id']), None)
+
+    def _remove(self, attempt_id):
+        _, attempt = self._attempts.pop(attempt_id, (None, None))
+        if attempt and self._open.get((attempt['user_id'], attempt['quiz_id'])) == attempt_id:
+            del self._open[(attempt['user_id'], attempt['quiz_id'])]
+        return attempt
+
+    def _live(self, attempt_id):
+        entry = self._attempts.get(attempt_id)
+        if entry is None:
+            return None
+        last_used, attempt = entry
+        if time.monotonic() - last_used > self.ttl:
+            self._remove(attempt_id)
+            return None
+        return attempt
+
+    def start(self, user_id, quiz_id, total_questions):
+        attempt = new_attempt(user_id, quiz_id, total_questions)
+        with self._lock:
+            previous = self._open.get((user_id, quiz_id))
+            if previous:
+                self._remove(previous)
+            self._touch(attempt)
+        return attempt
+
+    def get(self, attempt_id):
+        with self._lock:
+            attempt = self._live(attempt_id)
+            if attempt:
+                self._touch(attempt)
+            return attempt
+
+    def find_open(self, user_id, quiz_id):
+        with self._lock:
+            attempt_id = self._open.get((user_id, quiz_id))
+            return self._live(attempt_id) if attempt_id else None
+
+    def save_answer(self, attempt_id, question_id, selected_option):
+        with self._lock:
+            attempt = self._live(attempt_id)
+            if attempt:
+                attempt['answers'][question_id] = selected_option
+                self._touch(attempt)
+
+    def advance(self, attempt_id, current_question_index):
+        with self._lock:
+            attempt = self._live(attempt_id)
+            if attempt:
+                attempt['current_question_index'] = current_question_index
+                self._touch(attempt)
+
+    def finish(self, attempt_id):
+        """Removes the attempt and returns its final state."""
+        with self._lock:
+            return self._remove(attempt_id)
+
+
+class DatabaseAttemptStore:
+    """Keeps attempts in the quiz_attempt/attempt_answer tables so they survive restarts and can be
+    resumed from any device or worker. Each answer is written as its own small row.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def _as_dict(self, row):
+        answers = AttemptAnswer.query.filter_by(attempt_id=row.id).all()
+        return {
+            'id': row.id,
+            'user_id': row.user_id,
+            'quiz_id': row.quiz_id,
+            'current_question_index': row.current_question_index,
+            'total_questions': row.total_questions,
+            'answers': {answer.question_id: answer.selected_option for answer in answers},
+        }
+
+    def _expired(self, row):
+        return row.updated_at < datetime.now() - timedelta(seconds=self.ttl)
+
+    def _delete(self, attempt_id):
+        AttemptAnswer.query.filter_by(attempt_id=attempt_id).delete()
+        QuizAttempt.query.filter_by(id=attempt_id).delete()
+
+    def start(self, user_id, quiz_id, total_questions):
+        for row in QuizAttempt.query.filter_by(user_id=user_id, quiz_id=quiz_id).all():
+            self._delete(row.id)
+        attempt = new_attempt(user_id, quiz_id, total_questions)
+        db.session.add(QuizAttempt(id=attempt['id'], user_id=user_id, quiz_id=quiz_id,
+                                   total_questions=total_questions))
+        db.session.commit()
+        return attempt
+
+    def get(self, attempt_id):
+        row = db.session.get(QuizAttempt, attempt_id) if attempt_id else None
+        if row is None or self._expired(row):
+            return None
+        return self._as_dict(row)
+
+    def find_open(self, user_id, quiz_id):
+        row = QuizAttempt.query.filter_by(user_id=user_id, quiz_id=quiz_id) \
+            .order_by(QuizAttempt.updated_at.desc()).first()
+        if row is None or self._expired(row):
+            return None
+        return self._as_dict(row)
+
+    def save_answer(self, attempt_id, question_id, selected_option):
+        upsert(db.session, AttemptAnswer,
+               dict(attempt_id=attempt_id, question_id=question_id, selected_option=selected_option),
+               ['attempt_id', 'question_id'], {AttemptAnswer.selected_option: selected_option})
+        QuizAttempt.query.filter_by(id=attempt_id).update({QuizAttempt.updated_at: datetime.now()})
+        db.session.commit()
+
+    def advance(self, attempt_id, current_question_index):
+        QuizAttempt.query.filter_by(id=attempt_id).update({
+            QuizAttempt.current_question_index: current_question_index,
+            QuizAttempt.updated_at: datetime.now(),
+        })
+        db.session.commit()
+
+    def finish(self, attempt_id):
+        """Removes the attempt and returns its final state. The caller commits."""
+        row = db.session.get(QuizAttempt, attempt_id)
+        if row is None:
+            return None
+        attempt = self._as_dict(row)
+        self._delete(attempt_id)
+        return attempt
+
+
+ATTEMPT_STORES = {
+    'memory': lambda config: MemoryAttemptStore(config['ATTEMPT_CACHE_SIZE'], config['ATTEMPT_TTL']),
+    'database': lambda config: DatabaseAttemptStore(config['ATTEMPT_TTL']),
+}
+
+_store = None
+
+
+def attempt_store():
+    """The attempt store selected by the ATTEMPT_STORE setting."""
+    global _store
+    if _store is None:
+        _store = ATTEMPT_STORES[app.config['ATTEMPT_STORE']](app.config)
+    return _store
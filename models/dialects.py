@@ -0,0 +1,78 @@
+import io
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE (SQLite 3.24+, PostgreSQL 9.5+)
+_UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def upsert(session, model, values, key, set_):
+    """Inserts a row, or when one with the same key columns exists applies set_ to it instead;
+    the caller commits.
+
+    set_ maps columns to expressions on the existing row, e.g. {Model.count: Model.count + 1}.
+    SQLite and PostgreSQL do this in one INSERT ... ON CONFLICT statement, which also cannot race
+    another transaction inserting the same key. Other databases update first and insert if no
+    row was updated.
+    """
+    insert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        session.execute(insert(model).values(**values).on_conflict_do_update(index_elements=key, set_=set_))
+        return
+    updated = session.query(model).filter_by(**{column: values[column] for column in key}) \
+        .update(set_, synchronize_session=False)
+    if not updated:
+        session.execute(model.__table__.insert().values(**values))
+
+
+def copy_driver(conn):
+    """The psycopg major version (3 or 2) behind a PostgreSQL connection, or None when the
+    connection has no COPY support."""
+    if conn.dialect.name != 'postgresql':
+        return None
+    return {'psycopg': 3, 'psycopg2': 2}.get(conn.dialect.driver)
+
+
+def _copy_text(value):
+    """A value as a field of COPY's text format: NULL as \\N, so an empty string stays an empty string."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(conn, table, columns, rows):
+    """Loads rows (sequences in column order) into a table with COPY ... FROM STDIN, in the
+    connection's transaction. Needs copy_driver(conn)."""
+    statement = f'COPY {table.name} ({", ".join(columns)}) FROM STDIN'
+    cursor = conn.connection.cursor()
+    try:
+        if copy_driver(conn) == 3:
+            with cursor.copy(statement) as copy:
+                for row in rows:
+                    copy.write_row(row)
+        else:
+            # The text format, as psycopg 3 writes it, so both drivers load the same values
+            buffer = io.StringIO(''.join('\t'.join(map(_copy_text, row)) + '\n' for row in rows))
+            cursor.copy_expert(statement, buffer)
+    except conn.dialect.dbapi.Error as error:
+        # Raised like any other failed statement, so callers catching SQLAlchemyError see it
+        raise DBAPIError.instance(statement, None, error, conn.dialect.dbapi.Error)
+    finally:
+        cursor.close()
+
+
+def copy_out(conn, query, options='FORMAT csv, HEADER'):
+    """Yields the result of a select as text chunks formatted by the server with COPY ... TO STDOUT.
+    Needs copy_driver(conn) == 3: psycopg2 can only copy into a whole file, not stream it."""
+    compiled = query.compile(dialect=conn.dialect)
+    statement = f'COPY ({compiled.string}) TO STDOUT WITH ({options})'
+    cursor = conn.connection.cursor()
+    try:
+        with cursor.copy(statement, compiled.params) as copy:
+            for data in copy:
+                yield bytes(data).decode('utf-8')
+    except conn.dialect.dbapi.Error as error:
+        raise DBAPIError.instance(statement, compiled.params, error, conn.dialect.dbapi.Error)
+    finally:
+        cursor.close()
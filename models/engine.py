@@ -0,0 +1,100 @@
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Bind key of the read-only engine that analytics queries are routed to
+ANALYTICS_BIND = 'analytics'
+
+
+def _is_memory_sqlite(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the 'tuned' profile: a sized connection pool.
+
+    In-memory SQLite keeps Flask-SQLAlchemy's single shared connection.
+    """
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if config['SQLITE_PROFILE'] != 'tuned' or not uri or _is_memory_sqlite(uri):
+        return {}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+    }
+
+
+def analytics_uri(config):
+    """URI of the read-only engine for analytics, or None to read everything from the primary.
+
+    ANALYTICS_DATABASE_URI names a replica. Without one, a SQLite database file is opened a
+    second time in mode=ro; any other database needs a replica URI to be split.
+    """
+    if config['ANALYTICS_READS'] != 'replica':
+        return None
+    if config.get('ANALYTICS_DATABASE_URI'):
+        return config['ANALYTICS_DATABASE_URI']
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or _is_memory_sqlite(uri):
+        return None
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite':
+        return None
+    database = url.database if url.query.get('uri') else f'file:{url.database}'
+    url = url.set(database=database).update_query_dict({'mode': 'ro', 'uri': 'true'})
+    return url.render_as_string(hide_password=False)
+
+
+def sqlite_pragmas(config, read_only=False):
+    """The PRAGMA statements run on every new SQLite connection under the 'tuned' profile.
+
+    busy_timeout comes first so that switching to WAL waits for other connections. A read-only
+    connection cannot change the journal mode and has nothing to sync; it refuses writes instead.
+    """
+    if config['SQLITE_PROFILE'] != 'tuned':
+        return []
+    if read_only:
+        return [
+            f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+            "PRAGMA query_only = 1",
+            f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}",
+            f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}",
+        ]
+    return [
+        f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+        f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}",
+        f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}",
+    ]
+
+
+def install_pragmas(engine, pragmas):
+    """Runs the pragmas on each connection the engine opens, if it is a SQLite engine."""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+class RoutingSession(Session):
+    """db.session, sending SELECTs to the analytics engine while session.info['analytics_reads']
+    is set (see models.analytics.analytics_reads). Flushes, other statements and everything
+    outside that block use the primary; without an analytics engine nothing changes."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and self.info.get('analytics_reads') and not self._flushing
+                and getattr(clause, 'is_select', False)):
+            engine = self._db.engines.get(ANALYTICS_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
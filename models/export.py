@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+import os
+from datetime import timedelta
+
+import click
+from sqlalchemy import func
+
+from app import app
+from models.models import db, User, Subject, Chapter, Quiz, Score
+from models.analytics import analytics_reads
+from models.dialects import copy_driver, copy_out
+
+FORMATS = ('csv', 'jsonl')
+
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+# Output columns of a score export, in order
+COLUMNS = [
+    ('score_id', Score.id),
+    ('attempted_at', Score.time_stamp_of_attempt),
+    ('user_id', User.id),
+    ('username', User.username),
+    ('full_name', User.full_name),
+    ('subject_id', Subject.id),
+    ('subject', Subject.name),
+    ('chapter_id', Chapter.id),
+    ('chapter', Chapter.name),
+    ('quiz_id', Quiz.id),
+    ('quiz', Quiz.title),
+    ('total_scored', Score.total_scored),
+    ('question_count', Quiz.question_count),
+]
+
+HEADER = [name for name, _ in COLUMNS]
+
+
+def score_query(start=None, end=None, subject_id=None, quiz_id=None, columns=None):
+    """Every score with its user, quiz, chapter and subject, oldest first; columns are the
+    COLUMNS expressions by default. start and end are dates and both are included."""
+    columns = columns or [column for _, column in COLUMNS]
+    query = db.select(*[column.label(name) for (name, _), column in zip(COLUMNS, columns)]) \
+        .join(User, User.id == Score.user_id) \
+        .join(Quiz, Quiz.id == Score.quiz_id) \
+        .join(Chapter, Chapter.id == Quiz.chapter_id) \
+        .join(Subject, Subject.id == Chapter.subject_id)
+    if start is not None:
+        query = query.where(Score.time_stamp_of_attempt >= start)
+    if end is not None:
+        query = query.where(Score.time_stamp_of_attempt < end + timedelta(days=1))
+    if subject_id is not None:
+        query = query.where(Chapter.subject_id == subject_id)
+    if quiz_id is not None:
+        query = query.where(Score.quiz_id == quiz_id)
+    return query.order_by(Score.id)
+
+
+def score_rows(**filters):
+    """The rows of score_query(), fetched EXPORT_CHUNK_SIZE rows at a time so that only one chunk
+    is in memory."""
+    query = score_query(**filters).execution_options(yield_per=app.config['EXPORT_CHUNK_SIZE'])
+    return db.session.execute(query)
+
+
+# The COPY export has the server format the rows; timestamps are cast to the isoformat() text
+COPY_COLUMNS = [func.replace(db.cast(column, db.Text), ' ', 'T') if name == 'attempted_at' else column
+                for name, column in COLUMNS]
+
+
+def _value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def _csv_chunk(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([[_value(value) for value in row] for row in rows])
+    return buffer.getvalue()
+
+
+def _jsonl_chunk(rows):
+    return ''.join(json.dumps(dict(zip(HEADER, map(_value, row)))) + '\n' for row in rows)
+
+
+def export_scores(fmt, **filters):
+    """The export as text chunks of EXPORT_CHUNK_SIZE rows each, for a streamed response or a file.
+
+    A CSV export from PostgreSQL (with psycopg 3) streams the output of COPY ... TO STDOUT instead.
+    """
+    copy_query = score_query(**filters, columns=COPY_COLUMNS)
+    with analytics_reads():
+        conn = db.session.connection(bind_arguments={'clause': copy_query})
+        server_csv = fmt == 'csv' and copy_driver(conn) == 3
+        if not server_csv:
+            result = score_rows(**filters)  # The cursor stays on the connection it was opened on
+    if server_csv:
+        yield from copy_out(conn, copy_query)
+        return
+    if fmt == 'csv':
+        yield _csv_chunk([HEADER])
+        chunk = _csv_chunk
+    else:
+        chunk = _jsonl_chunk
+    for rows in result.partitions():
+        yield chunk(rows)
+
+
+@app.cli.command('export-scores')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='File to write (standard output if omitted).')
+@click.option('--from', 'start', type=click.DateTime(['%Y-%m-%d']), help='First day to include (YYYY-MM-DD).')
+@click.option('--to', 'end', type=click.DateTime(['%Y-%m-%d']), help='Last day to include (YYYY-MM-DD).')
+@click.option('--subject-id', type=int)
+@click.option('--quiz-id', type=int)
+def export_scores_command(fmt, output, start, end, subject_id, quiz_id):
+    """Writes every score with its user, quiz, chapter and subject as CSV or JSON lines."""
+    chunks = export_scores(fmt, start=start.date() if start else None, end=end.date() if end else None,
+                           subject_id=subject_id, quiz_id=quiz_id)
+    if output is None:
+        for chunk in chunks:
+            click.echo(chunk, nl=False)
+        return
+    # Write next to the target and rename, so a nightly job never leaves half a file behind
+    partial = output + '.partial'
+    with open(partial, 'w', encoding='utf-8', newline='') as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+    os.replace(partial, output)
+    print(f'Exported scores to {output}.')
@@ -0,0 +1,157 @@
+import threading
+
+import numpy as np
+
+from models.models import db, Quiz, Question
+
+# Compiled answer keys by quiz id, shared by every request in this process
+_answer_keys = {}
+_answer_keys_lock = threading.Lock()
+
+
+def correct_option(question):
+    """Position (1-4) of the option whose text is the question's correct answer, 0 if none matches."""
+    options = [question.option1, question.option2, question.option3, question.option4]
+    for option_id, text in enumerate(options, start=1):
+        if text == question.correct_answer:
+            return option_id
+    return 0
+
+
+class AnswerKey:
+    """The correct option of every question of a quiz as a compact array, in question id order."""
+
+    def __init__(self, version, question_ids, correct):
+        self.version = version
+        self.question_ids = np.asarray(question_ids, dtype=np.int64)
+        self.correct = np.asarray(correct, dtype=np.int8)
+        self.positions = {question_id: i for i, question_id in enumerate(question_ids)}
+
+    def __len__(self):
+        return len(self.question_ids)
+
+    def __contains__(self, question_id):
+        return question_id in self.positions
+
+    def answer_matrix(self, submissions):
+        """Lays out a list of {question_id: option_id} dicts as a submissions x questions array (0 = unanswered)."""
+        matrix = np.zeros((len(submissions), len(self)), dtype=np.int8)
+        for row, answers in enumerate(submissions):
+            for question_id, option_id in answers.items():
+                position = self.positions.get(question_id)
+                if position is not None and option_id:
+                    matrix[row, position] = option_id
+        return matrix
+
+    def packed_matrix(self, packed_answers):
+        """Like answer_matrix() but for answers stored with pack_answers(), without unpacking to dicts."""
+        matrix = np.zeros((len(packed_answers), len(self)), dtype=np.int8)
+        for row, packed in enumerate(packed_answers):
+            values = np.frombuffer(packed, dtype='<u4')
+            question_ids = (values >> 3).astype(np.int64)
+            positions = np.searchsorted(self.question_ids, question_ids)
+            # Drop answers to questions that are no longer part of the quiz
+            known = positions < len(self)
+            known[known] = self.question_ids[positions[known]] == question_ids[known]
+            matrix[row, positions[known]] = (values[known] & 7).astype(np.int8)
+        return matrix
+
+    def grade_matrix(self, matrix):
+        """Scores every row of an answer matrix at once."""
+        return ((matrix == self.correct) & (matrix > 0)).sum(axis=1)
+
+    def grade(self, answers):
+        """Number of answers ({question_id: option_id}) that match the key."""
+        return sum(1 for question_id, option_id in answers.items()
+                   if option_id and question_id in self.positions
+                   and self.correct[self.positions[question_id]] == option_id)
+
+
+def pack_answers(answers):
+    """Packs {question_id: option_id} into 4 bytes per answer: question id << 3 | option id.
+
+    Raises ValueError for an option id outside 1-4 or a question id that does not fit in 29 bits.
+    """
+    packed = []
+    for question_id, option_id in sorted(answers.items()):
+        if not option_id:
+            continue
+        if not 1 <= option_id <= 4:
+            raise ValueError(f"Invalid option for question {question_id}: {option_id}")
+        if not 0 <= question_id < 1 << 29:
+            raise ValueError(f"Question id out of range: {question_id}")
+        packed.append(question_id << 3 | option_id)
+    return np.asarray(packed, dtype='<u4').tobytes()
+
+
+def unpack_answers(packed):
+    """Reverses pack_answers()."""
+    values = np.frombuffer(packed, dtype='<u4')
+    return dict(zip((values >> 3).tolist(), (values & 7).tolist()))
+
+
+def answer_key_query(quiz_id):
+    """The question rows an answer key is compiled from."""
+    return db.select(Question.id, Question.option1, Question.option2, Question.option3,
+                     Question.option4, Question.correct_answer) \
+        .where(Question.quiz_id == quiz_id).order_by(Question.id)
+
+
+def key_from_rows(version, rows):
+    return AnswerKey(version, [row.id for row in rows], [correct_option(row) for row in rows])
+
+
+def compile_answer_key(quiz_id, version):
+    return key_from_rows(version, db.session.execute(answer_key_query(quiz_id)).all())
+
+
+def _cached_key(quiz_id, version):
+    with _answer_keys_lock:
+        key = _answer_keys.get(quiz_id)
+    return key if key is not None and key.version == version else None
+
+
+def _cache_key(quiz_id, key):
+    with _answer_keys_lock:
+        _answer_keys[quiz_id] = key
+
+
+def answer_key(quiz_id, version=None):
+    """The compiled answer key of a quiz, from the cache when it is still current.
+
+    Pass the quiz's questions_version when the quiz is already loaded; otherwise it is looked up.
+    Keys compiled by other worker processes are refreshed through the version check.
+    """
+    if version is None:
+        version = db.session.query(Quiz.questions_version).filter(Quiz.id == quiz_id).scalar()
+    key = _cached_key(quiz_id, version)
+    if key is None:
+        key = compile_answer_key(quiz_id, version)
+        _cache_key(quiz_id, key)
+    return key
+
+
+async def answer_key_async(session, quiz_id, version):
+    """answer_key() for the async API: the same cache, compiled through an AsyncSession."""
+    key = _cached_key(quiz_id, version)
+    if key is None:
+        key = key_from_rows(version, (await session.execute(answer_key_query(quiz_id))).all())
+        _cache_key(quiz_id, key)
+    return key
+
+
+def invalidate_answer_key(quiz_id):
+    """Drops a quiz's compiled key after its questions change."""
+    with _answer_keys_lock:
+        _answer_keys.pop(quiz_id, None)
+
+
+def grade(quiz_id, answers, version=None):
+    """Grades one attempt ({question_id: option_id}) or, given a list of attempts, all of them at once.
+
+    A list returns a NumPy array of scores in the same order.
+    """
+    key = answer_key(quiz_id, version)
+    if isinstance(answers, dict):
+        return key.grade(answers)
+    return key.grade_matrix(key.answer_matrix(answers))
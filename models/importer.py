@@ -0,0 +1,350 @@
+import csv
+import json
+import os
+import re
+from datetime import datetime, time
+
+import click
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app
+from models.models import db, Subject, Chapter, Quiz, Question, CacheGeneration
+from models.grading import invalidate_answer_key
+from models.search import index_documents
+from models.dialects import copy_driver, copy_rows
+
+FORMATS = ('csv', 'json', 'jsonl')
+
+# Fields of an import row. Every row names its subject, chapter and quiz, which are created the
+# first time they are seen; a row without a question only makes sure they exist.
+COLUMNS = ['subject', 'subject_description', 'chapter', 'chapter_description',
+           'quiz', 'quiz_date', 'quiz_duration', 'quiz_remarks',
+           'question', 'option1', 'option2', 'option3', 'option4', 'correct_answer']
+
+OPTIONS = ['option1', 'option2', 'option3', 'option4']
+
+# Question table columns written by an import
+QUESTION_COLUMNS = ['quiz_id', 'question_statement', *OPTIONS, 'correct_answer']
+
+# Longest value each String column takes
+MAX_LENGTHS = {'subject': 120, 'chapter': 120, 'quiz': 255, 'option1': 255, 'option2': 255,
+               'option3': 255, 'option4': 255}
+
+
+def format_of(filename):
+    """The import format implied by a file name, or None."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    return {'.csv': 'csv', '.json': 'json', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}.get(extension)
+
+
+# SECTION: readers. Each yields one row at a time (a dict, or the ValueError that made a row unreadable).
+
+def read_csv(stream):
+    yield from csv.DictReader(stream)
+
+
+def read_jsonl(stream):
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                yield error
+
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+# Where the next element starts after a malformed one: the end of a row object and a comma (or the
+# closing bracket). Rows are flat objects, so a '}' outside a string only ever ends one
+_ELEMENT_END = re.compile(r'\}\s*([,\]])')
+
+
+def read_json(stream, chunk_size=64 * 1024, max_element_size=1024 * 1024):
+    """Yields the elements of a top-level JSON array, reading the file a chunk at a time.
+
+    An element that does not parse within max_element_size characters is yielded as its error and
+    reading resumes at the next element, so a malformed row neither pulls the rest of the file into
+    memory nor hides the rows after it.
+    """
+    decoder = json.JSONDecoder()
+    buffer = stream.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        yield ValueError('expected a JSON array of rows')
+        return
+    position = 1
+    eof = False
+    while True:
+        position = _SEPARATORS.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        try:
+            value, position = decoder.raw_decode(buffer, position)
+        except ValueError as error:
+            if not eof and len(buffer) - position < max_element_size:
+                # Most likely the element runs past the end of the buffer
+                chunk = stream.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield error
+            # Skip to the end of the malformed element, keeping only a short tail in memory
+            end = _ELEMENT_END.search(buffer, position + 1)
+            while end is None and not eof:
+                chunk = stream.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[-64:] + chunk
+                end = _ELEMENT_END.search(buffer)
+            if end is None or end.group(1) == ']':
+                return
+            position = end.end()
+            continue
+        yield value
+
+
+READERS = {'csv': read_csv, 'json': read_json, 'jsonl': read_jsonl}
+
+
+# SECTION: validation
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def clean_row(row):
+    """The fields of one import row, stripped and checked. Raises ValueError with the reason."""
+    if not isinstance(row, dict):
+        raise ValueError('expected an object with named fields')
+    values = {column: _text(row.get(column)) for column in COLUMNS}
+
+    for column in ('subject', 'chapter', 'quiz'):
+        if values[column] is None:
+            raise ValueError(f'{column} is required')
+    for column, length in MAX_LENGTHS.items():
+        if values[column] is not None and len(values[column]) > length:
+            raise ValueError(f'{column} is longer than {length} characters')
+
+    if values['quiz_date'] is not None:
+        try:
+            values['quiz_date'] = datetime.strptime(values['quiz_date'], '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError('quiz_date must be YYYY-MM-DD')
+    if values['quiz_duration'] is not None:
+        try:
+            hours, minutes = map(int, values['quiz_duration'].split(':'))
+            values['quiz_duration'] = time(hours, minutes, 0)
+        except ValueError:
+            raise ValueError('quiz_duration must be HH:MM')
+
+    if any(values[column] is not None for column in ['question', *OPTIONS, 'correct_answer']):
+        if values['question'] is None:
+            raise ValueError('question is required when options are given')
+        options = [values[column] for column in OPTIONS]
+        if None in options:
+            raise ValueError('a question needs all four options')
+        # The correct answer is stored as the text of the right option; a number picks it by position
+        answer = values['correct_answer']
+        if answer not in options:
+            if answer in ('1', '2', '3', '4'):
+                values['correct_answer'] = options[int(answer) - 1]
+            else:
+                raise ValueError('correct_answer must be one of the options or 1-4')
+    return values
+
+
+# SECTION: import
+
+class ImportReport:
+    """What an import did: rows read, rows created by kind, and the rejected rows (the first max_errors of them)."""
+
+    def __init__(self, max_errors):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.created = {'subjects': 0, 'chapters': 0, 'quizzes': 0, 'questions': 0}
+        self.error_count = 0
+        self.errors = []  # (row number, message)
+
+    def reject(self, row_number, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((row_number, message))
+
+    def summary(self):
+        created = ', '.join(f'{count} {kind}' for kind, count in self.created.items())
+        return f'Read {self.rows} rows: created {created}; rejected {self.error_count} rows.'
+
+
+class Importer:
+    """Adds validated rows to the database, batch_size rows per transaction.
+
+    Subjects, chapters and quizzes are looked up (or created) by name when first seen and then
+    remembered by id, so memory grows with the number of quizzes and not with the number of
+    questions. Every batch is its own transaction: question counters, the search index and the
+    content generation move with it, and a batch that fails takes none of its rows with it.
+    """
+
+    def __init__(self, batch_size, report, on_error=None):
+        self.batch_size = batch_size
+        self.report = report
+        self.on_error = on_error
+        self._subjects = {}  # name -> id
+        self._chapters = {}  # (subject id, name) -> id
+        self._quizzes = {}  # (chapter id, title) -> id
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._questions = []
+        self._row_numbers = []
+        self._question_counts = {}  # quiz id -> questions added in this batch
+        self._created = dict.fromkeys(self.report.created, 0)
+
+    def reject(self, row_number, message):
+        self.report.reject(row_number, message)
+        if self.on_error:
+            self.on_error(row_number, message)
+
+    def _create(self, kind, row):
+        db.session.add(row)
+        db.session.flush()  # Fires the search index events and assigns the id
+        self._created[kind] += 1
+        return row.id
+
+    def _quiz_id(self, values):
+        subject_id = self._subjects.get(values['subject'])
+        if subject_id is None:
+            subject = Subject.query.filter_by(name=values['subject']).first()
+            subject_id = subject.id if subject else self._create(
+                'subjects', Subject(name=values['subject'], description=values['subject_description']))
+            self._subjects[values['subject']] = subject_id
+
+        chapter_key = (subject_id, values['chapter'])
+        chapter_id = self._chapters.get(chapter_key)
+        if chapter_id is None:
+            chapter = Chapter.query.filter_by(subject_id=subject_id, name=values['chapter']) \
+                .order_by(Chapter.id).first()
+            chapter_id = chapter.id if chapter else self._create(
+                'chapters', Chapter(subject_id=subject_id, name=values['chapter'],
+                                    description=values['chapter_description']))
+            self._chapters[chapter_key] = chapter_id
+
+        quiz_key = (chapter_id, values['quiz'])
+        quiz_id = self._quizzes.get(quiz_key)
+        if quiz_id is None:
+            quiz = Quiz.query.filter_by(chapter_id=chapter_id, title=values['quiz']).order_by(Quiz.id).first()
+            quiz_id = quiz.id if quiz else self._create(
+                'quizzes', Quiz(chapter_id=chapter_id, title=values['quiz'], date_of_quiz=values['quiz_date'],
+                                time_duration=values['quiz_duration'], remarks=values['quiz_remarks']))
+            self._quizzes[quiz_key] = quiz_id
+        return quiz_id
+
+    def add(self, row_number, values):
+        try:
+            quiz_id = self._quiz_id(values)
+        except SQLAlchemyError as error:
+            self._fail([row_number], error)
+            return
+        self._row_numbers.append(row_number)
+        if values['question'] is not None:
+            self._questions.append({
+                'quiz_id': quiz_id,
+                'question_statement': values['question'],
+                **{column: values[column] for column in OPTIONS},
+                'correct_answer': values['correct_answer'],
+            })
+            self._question_counts[quiz_id] = self._question_counts.get(quiz_id, 0) + 1
+        if len(self._row_numbers) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Commits the pending batch."""
+        if not self._row_numbers:
+            return
+        try:
+            if self._questions:
+                self._insert_questions()
+            if self._question_counts:
+                # Quiz.change_question_count() for every quiz of the batch, as one executemany
+                db.session.execute(
+                    db.update(Quiz.__table__).where(Quiz.__table__.c.id == bindparam('quiz_id')).values(
+                        question_count=Quiz.__table__.c.question_count + bindparam('added'),
+                        questions_version=Quiz.__table__.c.questions_version + 1),
+                    [{'quiz_id': quiz_id, 'added': count} for quiz_id, count in self._question_counts.items()])
+            CacheGeneration.bump()
+            db.session.commit()
+        except SQLAlchemyError as error:
+            self._fail(self._row_numbers, error)
+            return
+        for quiz_id in self._question_counts:
+            invalidate_answer_key(quiz_id)
+        for kind, count in self._created.items():
+            self.report.created[kind] += count
+        self._reset_batch()
+
+    def _insert_questions(self):
+        """Writes the batch's questions: with COPY on PostgreSQL, elsewhere as one executemany.
+        The ORM events run for neither, so the search index is filled here."""
+        conn = db.session.connection()
+        if copy_driver(conn):
+            # PostgreSQL searches the tables themselves (trigram indexes), so no ids are needed
+            copy_rows(conn, Question.__table__, QUESTION_COLUMNS,
+                      [[question[column] for column in QUESTION_COLUMNS] for question in self._questions])
+            self._created['questions'] = len(self._questions)
+            return
+        ids = db.session.scalars(db.insert(Question).returning(Question.id, sort_by_parameter_order=True),
+                                 self._questions).all()
+        index_documents(conn, 'questions', [(question_id, question['question_statement'], None)
+                                            for question_id, question in zip(ids, self._questions)])
+        self._created['questions'] = len(ids)
+
+    def _fail(self, row_numbers, error):
+        """Rolls back the pending batch and rejects its rows, plus the row being added when that failed."""
+        db.session.rollback()
+        message = f'not saved: {error.__class__.__name__}: {getattr(error, "orig", None) or error}'
+        for row_number in sorted(set(self._row_numbers) | set(row_numbers)):
+            self.reject(row_number, message)
+        # Parents created in the batch were rolled back with it
+        self._subjects.clear()
+        self._chapters.clear()
+        self._quizzes.clear()
+        self._reset_batch()
+
+
+def import_stream(stream, fmt, batch_size=None, on_error=None):
+    """Imports the rows of an open text stream in the given format. Returns an ImportReport.
+
+    on_error(row number, message) is called for every rejected row, as it is rejected. Row
+    numbers count the rows of the file from 1, not counting a CSV header.
+    """
+    report = ImportReport(app.config['IMPORT_MAX_ERRORS'])
+    importer = Importer(batch_size or app.config['IMPORT_BATCH_SIZE'], report, on_error)
+    for row_number, row in enumerate(READERS[fmt](stream), start=1):
+        report.rows += 1
+        if isinstance(row, Exception):
+            importer.reject(row_number, f'unreadable: {row}')
+            continue
+        try:
+            values = clean_row(row)
+        except ValueError as error:
+            importer.reject(row_number, str(error))
+            continue
+        importer.add(row_number, values)
+    importer.flush()
+    return report
+
+
+@app.cli.command('import-content')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', type=int, default=None, help='Rows written per transaction.')
+def import_content_command(path, fmt, batch_size):
+    """Imports subjects, chapters, quizzes and questions from a CSV, JSON or JSONL file."""
+    fmt = fmt or format_of(path)
+    if fmt is None:
+        raise click.UsageError('Cannot tell the format from the file name; pass --format.')
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        report = import_stream(stream, fmt, batch_size, on_error=lambda row, message: print(f'Row {row}: {message}'))
+    print(report.summary())
@@ -0,0 +1,501 @@
+import atexit
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+
+import click
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app import app
+from models.models import db, Quiz, Score, UserQuizStats, UserWeeklyStats
+from models.grading import pack_answers
+from models.leaderboard import add_to_leaderboards
+
+
+def record_score(quiz_id, user_id, total_marks, answers, attempted_at=None, ack_id=None):
+    """Adds a Score row with its packed answers and updates the quiz counters, the user's
+    statistics and the leaderboards; the caller commits."""
+    attempted_at = attempted_at or datetime.now()
+    score = Score(
+        quiz_id=quiz_id,
+        user_id=user_id,
+        time_stamp_of_attempt=attempted_at,
+        total_scored=total_marks,
+        answers=pack_answers(answers),
+        ack_id=ack_id
+    )
+    db.session.add(score)
+    Quiz.record_attempt(quiz_id, total_marks)
+    UserQuizStats.record_attempt(user_id, quiz_id, total_marks, attempted_at)
+    UserWeeklyStats.record_attempt(user_id, total_marks, attempted_at)
+    add_to_leaderboards(score)
+    return score
+
+
+# Journal files of a queue: scores-<pid>-<token>-<segment>.jsonl, and scores-<pid>-<token>.lock, which
+# the queue holds locked while it runs. The token is random per queue, so a process that reuses a
+# dead one's pid (pid 1 in every container) never appends to or skips the dead queue's segments.
+_JOURNAL_FILE = re.compile(r'scores-(\d+)-([0-9a-f]+)(?:-\d+\.jsonl|\.lock)$')
+
+# Acknowledgement ids are uuid4().hex
+_ACK_ID = re.compile(r'[0-9a-f]{32}')
+
+# Errors that writing the same score again cannot get past; anything else (a locked or
+# unreachable database) is retried until it commits
+PERMANENT_ERRORS = (IntegrityError, DataError, ValueError, KeyError, TypeError)
+
+# Longest wait, in seconds, between attempts to write scores the database refused
+MAX_RETRY_DELAY = 30
+
+# Failed scores remembered for score_status(); they stay in failed-scores.jsonl either way
+FAILED_KEPT = 1000
+
+# Tokens of the queues running in this process
+_live_tokens = set()
+
+
+def _pid_alive(pid):
+    if os.name != 'posix':
+        return True  # No cheap check; leave the journal to flask replay-score-journal
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _lock_path(journal_dir, pid, token):
+    return os.path.join(journal_dir, f'scores-{pid}-{token}.lock')
+
+
+def _claim(journal_dir, pid, token, force=False):
+    """Takes the lock of the queue that wrote a journal, so one process replays it. Returns the
+    lock file, to close once the journal is replayed, or None while that queue may still be
+    running. force claims it regardless.
+
+    On POSIX the queue's own lock tells: it goes away with the process, whoever gets its pid next.
+    Elsewhere only a journal of this process's pid (left by an earlier process) or of a pid no
+    longer running is claimed.
+    """
+    if token in _live_tokens and not force:
+        return None
+    lock = open(_lock_path(journal_dir, pid, token), 'a')
+    if force:
+        return lock
+    if os.name == 'posix':
+        import fcntl
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+    elif pid != os.getpid() and _pid_alive(pid):
+        lock.close()
+        return None
+    return lock
+
+
+def replay_journals(journal_dir, replay_all=False):
+    """Replays the journals of queues that are no longer running (with replay_all, of every queue
+    but this process's). Returns the number of segments replayed and of scores written."""
+    owners = set()
+    for path in glob.glob(os.path.join(journal_dir, 'scores-*')):
+        match = _JOURNAL_FILE.match(os.path.basename(path))
+        if match:
+            owners.add((int(match.group(1)), match.group(2)))
+    segments = written = 0
+    for pid, token in sorted(owners):
+        if token in _live_tokens:
+            continue
+        lock = _claim(journal_dir, pid, token, force=replay_all)
+        if lock is None:
+            continue
+        with lock:
+            # Listed once claimed: another worker may have replayed the journal in the meantime
+            for path in sorted(glob.glob(os.path.join(journal_dir, f'scores-{pid}-{token}-*.jsonl'))):
+                written += replay_segment(path)
+                segments += 1
+            os.remove(lock.name)
+    return segments, written
+
+
+class ScoreQueue:
+    """Scores waiting to be written, saved to a journal first and committed by one writer thread.
+
+    submit() appends the score to this process's journal and returns its acknowledgement id at
+    once. The writer commits up to batch_size queued scores per transaction, as soon as that many
+    are waiting or flush_interval seconds after the oldest one arrived. Journal segments are
+    deleted once every score in them is committed; segments left behind by a process that died
+    are replayed when the next queue starts. Scores already in the table (by ack_id) are skipped,
+    so a replay never writes a score twice. A batch the database refuses (locked, unreachable) stays
+    queued and in its segment and is tried again after a growing pause; only scores that can never
+    be written go to failed-scores.jsonl.
+    """
+
+    def __init__(self, journal_dir, batch_size, flush_interval, fsync=False, segment_size=10000):
+        self.journal_dir = journal_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self._queue = deque()  # (segment, time queued, entry)
+        self._pending = {}  # ack id -> entry, until committed
+        self._failed = OrderedDict()  # ack id -> entry that can never be written, the last FAILED_KEPT
+        self._retry_delay = 0  # Seconds to wait before the next attempt, after the database refused a batch
+        self._retry_at = 0
+        self._condition = threading.Condition()
+        self._segment = 0
+        self._segment_file = None
+        self._segment_entries = 0
+        self._uncommitted = {}  # segment number -> entries not committed yet
+        self._stopping = False
+        self._thread = None
+        self._journal_index = {}  # path of another queue's segment -> (bytes indexed, {ack id: entry})
+        self._journal_index_lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+        self.token = uuid.uuid4().hex[:12]
+        _live_tokens.add(self.token)
+        self._lock = open(_lock_path(journal_dir, os.getpid(), self.token), 'a')
+        if os.name == 'posix':
+            import fcntl
+            fcntl.flock(self._lock, fcntl.LOCK_EX)  # Held until stop(), or until the process dies
+
+    # SECTION: journal
+
+    def _segment_path(self, segment):
+        return os.path.join(self.journal_dir, f'scores-{os.getpid()}-{self.token}-{segment:06d}.jsonl')
+
+    def _append(self, entry):
+        """Writes an entry to the current segment, starting a new one when it is full; call with the lock held."""
+        if self._segment_file is None or self._segment_entries >= self.segment_size:
+            if self._segment_file is not None:
+                self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(self._segment_path(self._segment), 'a', encoding='utf-8')
+            self._segment_entries = 0
+        self._segment_file.write(json.dumps(entry) + '\n')
+        self._segment_file.flush()  # Survives the process dying from here on
+        if self.fsync:
+            os.fsync(self._segment_file.fileno())  # And the machine losing power
+        self._segment_entries += 1
+        self._uncommitted[self._segment] = self._uncommitted.get(self._segment, 0) + 1
+        return self._segment
+
+    def _committed(self, segments):
+        """Drops segments whose entries are all committed; call with the lock held."""
+        for segment in segments:
+            self._uncommitted[segment] -= 1
+        for segment in set(segments):
+            if self._uncommitted[segment]:
+                continue
+            del self._uncommitted[segment]
+            if segment == self._segment:
+                self._segment_file.close()
+                self._segment_file = None
+            os.remove(self._segment_path(segment))
+
+    # SECTION: queue
+
+    def submit(self, quiz_id, user_id, total_scored, answers, attempted_at=None):
+        """Queues a score and returns its acknowledgement id."""
+        entry = {
+            'ack_id': uuid.uuid4().hex,
+            'quiz_id': quiz_id,
+            'user_id': user_id,
+            'total_scored': total_scored,
+            'answers': {str(question_id): option_id for question_id, option_id in answers.items()},
+            'attempted_at': (attempted_at or datetime.now()).isoformat(),
+        }
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError('The score queue is shut down')
+            segment = self._append(entry)
+            self._queue.append((segment, time.monotonic(), entry))
+            self._pending[entry['ack_id']] = entry
+            self._condition.notify()
+        self._ensure_writer()
+        return entry['ack_id']
+
+    def pending(self, ack_id):
+        """The queued entry of an acknowledgement id that is not committed yet, or None."""
+        with self._condition:
+            return self._pending.get(ack_id)
+
+    def failed(self, ack_id):
+        with self._condition:
+            return self._failed.get(ack_id)
+
+    def journaled(self, ack_id):
+        """The entry of an acknowledgement id queued by another worker and still in its journal, or None.
+
+        Other workers' segments are indexed in memory as they grow: a lookup lists the journal
+        and reads only what was appended since the last one, and forgets deleted segments.
+        """
+        if not _ACK_ID.fullmatch(ack_id):
+            return None
+        with self._journal_index_lock:
+            paths = [path for path in glob.glob(os.path.join(self.journal_dir, 'scores-*.jsonl'))
+                     if f'-{self.token}-' not in os.path.basename(path)]
+            for path in set(self._journal_index) - set(paths):
+                del self._journal_index[path]  # Committed
+            for path in paths:
+                indexed, entries = self._journal_index.get(path, (0, {}))
+                try:
+                    if os.stat(path).st_size > indexed:
+                        with open(path, 'rb') as stream:
+                            stream.seek(indexed)
+                            data = stream.read()
+                        # Whole lines only: a line still being written is read again next time
+                        end = data.rfind(b'\n') + 1
+                        for line in data[:end].splitlines():
+                            try:
+                                entry = json.loads(line)
+                            except ValueError:
+                                continue  # Torn: its submit() never returned
+                            entries[entry['ack_id']] = {key: entry[key] for key in ('user_id', 'quiz_id', 'total_scored')}
+                        indexed += end
+                except FileNotFoundError:
+                    continue  # Committed and deleted since the listing
+                self._journal_index[path] = (indexed, entries)
+            for _, entries in self._journal_index.values():
+                if ack_id in entries:
+                    return entries[ack_id]
+        return None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _ensure_writer(self):
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='score-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        """Waits until a batch is due and takes it off the queue; None once stopped and drained."""
+        with self._condition:
+            while True:
+                if self._queue:
+                    backoff = self._retry_at - time.monotonic()
+                    if backoff > 0 and not self._stopping:
+                        self._condition.wait(backoff)
+                        continue
+                    waited = time.monotonic() - self._queue[0][1]
+                    if len(self._queue) >= self.batch_size or waited >= self.flush_interval or self._stopping:
+                        return [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                    self._condition.wait(self.flush_interval - waited)
+                elif self._stopping:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            failed, retry = write_entries([entry for _, _, entry in batch])
+            if failed:
+                # Kept out of the segments, which are deleted below, for someone to look at
+                with open(os.path.join(self.journal_dir, 'failed-scores.jsonl'), 'a', encoding='utf-8') as stream:
+                    stream.writelines(json.dumps(entry) + '\n' for entry in failed)
+            retry_ids = {entry['ack_id'] for entry in retry}
+            with self._condition:
+                done = [item for item in batch if item[2]['ack_id'] not in retry_ids]
+                for _, _, entry in done:
+                    self._pending.pop(entry['ack_id'], None)
+                for entry in failed:
+                    self._failed[entry['ack_id']] = entry
+                    if len(self._failed) > FAILED_KEPT:
+                        self._failed.popitem(last=False)
+                self._committed([segment for segment, _, _ in done])
+                if not retry:
+                    self._retry_delay = 0
+                elif self._stopping:
+                    # Left in their segments, which the next queue to start replays
+                    app.logger.warning('Stopping with %d queued scores unwritten', len(retry) + len(self._queue))
+                    self._queue.clear()
+                else:
+                    # Back at the head of the queue, tried again after a growing pause
+                    self._queue.extendleft(reversed([item for item in batch if item[2]['ack_id'] in retry_ids]))
+                    self._retry_delay = min(max(self._retry_delay * 2, self.flush_interval, 0.1), MAX_RETRY_DELAY)
+                    self._retry_at = time.monotonic() + self._retry_delay
+
+    def stop(self):
+        """Writes everything still queued, then stops the writer."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            if self._lock is not None and not self._uncommitted:
+                _live_tokens.discard(self.token)
+                os.remove(self._lock.name)
+                self._lock.close()
+                self._lock = None
+
+    def recover(self):
+        """Replays journal segments left behind by queues that are no longer running, before this
+        one writes any. Returns the number of scores written."""
+        return replay_journals(self.journal_dir)[1]
+
+
+# SECTION: writing
+
+def _write(entries):
+    """Records the entries not in the table yet and commits them together. Returns how many were new."""
+    known = {ack_id for ack_id, in db.session.query(Score.ack_id)
+             .filter(Score.ack_id.in_([entry['ack_id'] for entry in entries]))}
+    new = [entry for entry in entries if entry['ack_id'] not in known]
+    for entry in new:
+        record_score(entry['quiz_id'], entry['user_id'], entry['total_scored'],
+                     {int(question_id): option_id for question_id, option_id in entry['answers'].items()},
+                     attempted_at=datetime.fromisoformat(entry['attempted_at']), ack_id=entry['ack_id'])
+    db.session.commit()
+    return len(new)
+
+
+def write_entries(entries):
+    """Commits a batch of queued scores in one transaction. If that fails they are retried one at
+    a time so a bad entry cannot hold up the others. Returns the entries that can never be written
+    (PERMANENT_ERRORS) and, from the first other error on, the entries to try again later."""
+    with app.app_context():
+        try:
+            _write(entries)
+            return [], []
+        except Exception:
+            db.session.rollback()
+        failed = []
+        for i, entry in enumerate(entries):
+            try:
+                _write([entry])
+            except PERMANENT_ERRORS:
+                db.session.rollback()
+                app.logger.exception('Could not write queued score %s', entry['ack_id'])
+                failed.append(entry)
+            except Exception:
+                db.session.rollback()
+                app.logger.warning('Could not write queued scores yet, will retry', exc_info=True)
+                return failed, entries[i:]
+        return failed, []
+
+
+def replay_segment(path):
+    """Writes the scores of a journal segment that are not in the table yet, then deletes it.
+    Returns the number written."""
+    with open(path, encoding='utf-8') as stream:
+        # A torn last line is an entry whose submit() never returned
+        entries = []
+        for line in stream:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+    written = 0
+    with app.app_context():
+        for start in range(0, len(entries), app.config['SCORE_QUEUE_BATCH_SIZE']):
+            written += _write(entries[start:start + app.config['SCORE_QUEUE_BATCH_SIZE']])
+    os.remove(path)
+    return written
+
+
+_score_queue = None
+_score_queue_lock = threading.Lock()
+
+
+def score_queue():
+    """This process's score queue, started on first use, or None when SCORE_WRITES is 'direct'."""
+    global _score_queue
+    if app.config['SCORE_WRITES'] != 'queue':
+        return None
+    with _score_queue_lock:
+        if _score_queue is None:
+            queue = ScoreQueue(app.config['SCORE_JOURNAL_DIR'], app.config['SCORE_QUEUE_BATCH_SIZE'],
+                               app.config['SCORE_QUEUE_FLUSH_MS'] / 1000, fsync=app.config['SCORE_JOURNAL_FSYNC'])
+            recovered = queue.recover()
+            if recovered:
+                app.logger.warning('Replayed %d queued scores from the journal', recovered)
+            atexit.register(queue.stop)  # Graceful shutdown drains the queue
+            _score_queue = queue
+        return _score_queue
+
+
+def submit_score(quiz_id, user_id, total_marks, answers):
+    """Saves a finished attempt: through the queue, returning its acknowledgement id, or when
+    SCORE_WRITES is 'direct' in the current transaction (the caller commits), returning None."""
+    queue = score_queue()
+    if queue is None:
+        record_score(quiz_id, user_id, total_marks, answers)
+        return None
+    return queue.submit(quiz_id, user_id, total_marks, answers)
+
+
+def write_score(quiz_id, user_id, total_marks, answers):
+    """Records and commits one score in an app context of its own, for callers outside a Flask
+    request (the async API runs it in a worker thread). Returns the score id."""
+    with app.app_context():
+        score = record_score(quiz_id, user_id, total_marks, answers)
+        db.session.commit()
+        return score.id
+
+
+def score_status_query(ack_id):
+    return db.select(Score.id, Score.user_id, Score.quiz_id, Score.total_scored).where(Score.ack_id == ack_id)
+
+
+def resolve_status(score, ack_id, user_id):
+    """score_status() given the score_status_query() row of the id (None if it is not saved yet).
+
+    When this returns None for an id that was not saved, query it again before answering: another
+    worker may have committed the score and dropped it from its journal since the first query.
+    """
+    if score is not None:
+        if score.user_id != user_id:
+            return None
+        return {'state': 'saved', 'score_id': score.id, 'quiz_id': score.quiz_id, 'total_scored': score.total_scored}
+    queue = score_queue()
+    if queue is None:
+        return None  # Every score is saved in its request, so nothing is on its way
+    for state, find in (('pending', queue.pending), ('failed', queue.failed), ('pending', queue.journaled)):
+        entry = find(ack_id)
+        if entry is not None:
+            if entry['user_id'] != user_id:
+                return None
+            return {'state': state, 'score_id': None, 'quiz_id': entry['quiz_id'],
+                    'total_scored': entry['total_scored']}
+    return None
+
+
+def score_status(ack_id, user_id):
+    """What became of a score a user submitted: a dict with its state ('saved', 'pending' or
+    'failed'), quiz_id, total_scored and, once saved, score_id. None if the id is unknown or
+    someone else's.
+
+    A score queued by another worker process is found in that worker's journal until it is committed.
+    """
+    score = db.session.execute(score_status_query(ack_id)).first()
+    status = resolve_status(score, ack_id, user_id)
+    if status is None and score is None:
+        score = db.session.execute(score_status_query(ack_id)).first()
+        status = resolve_status(score, ack_id, user_id) if score is not None else None
+    return status
+
+
+@app.cli.command('replay-score-journal')
+@click.option('--all', 'replay_all', is_flag=True,
+              help='Also replay segments whose process still seems to be running. Only when no worker is.')
+def replay_score_journal_command(replay_all):
+    """Writes queued scores left in the journal by workers that stopped without draining their queue."""
+    segments, written = replay_journals(app.config['SCORE_JOURNAL_DIR'], replay_all)
+    print(f'Replayed {segments} journal segments: {written} scores written.')
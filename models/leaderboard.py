@@ -0,0 +1,174 @@
+import math
+
+import click
+from sqlalchemy import case, func
+
+from app import app
+from models.models import db, Chapter, Quiz, Score, UserQuizStats, LeaderboardEntry, ScoreHistogram
+from models.dialects import upsert
+
+SCOPES = ('quiz', 'subject')
+SIDES = ('top', 'bottom')
+
+
+def score_value(scope, total_scored, question_count):
+    """What a board ranks an attempt by: the score on a quiz board, the percentage on a subject board."""
+    if scope == 'quiz':
+        return float(total_scored)
+    return total_scored * 100.0 / question_count if question_count else 0.0
+
+
+def bucket_of(value):
+    """Histogram bucket of a board value: the whole score, or the whole percent."""
+    return int(math.floor(value))
+
+
+def _board(scope, scope_id, side):
+    return LeaderboardEntry.query.filter_by(scope=scope, scope_id=scope_id, side=side)
+
+
+def _ranking(side):
+    """Board order: best (or worst) first, and the earlier attempt first among equal values."""
+    value = LeaderboardEntry.value.desc() if side == 'top' else LeaderboardEntry.value.asc()
+    return [value, LeaderboardEntry.time_stamp_of_attempt, LeaderboardEntry.id]
+
+
+def _offer(scope, scope_id, side, entry):
+    """Puts an attempt on a board if it ranks within LEADERBOARD_SIZE, dropping whatever it pushes off."""
+    size = app.config['LEADERBOARD_SIZE']
+    last = _board(scope, scope_id, side).order_by(*_ranking(side)).offset(size - 1).first()
+    if last is not None and not (entry['value'] > last.value if side == 'top' else entry['value'] < last.value):
+        return
+    db.session.execute(db.insert(LeaderboardEntry).values(scope=scope, scope_id=scope_id, side=side, **entry))
+    if last is not None:
+        keep = _board(scope, scope_id, side).with_entities(LeaderboardEntry.id) \
+            .order_by(*_ranking(side)).limit(size).scalar_subquery()
+        _board(scope, scope_id, side).filter(LeaderboardEntry.id.notin_(keep)).delete(synchronize_session=False)
+
+
+def _count(scope, scope_id, bucket):
+    upsert(db.session, ScoreHistogram, dict(scope=scope, scope_id=scope_id, bucket=bucket, count=1),
+           ['scope', 'scope_id', 'bucket'], {ScoreHistogram.count: ScoreHistogram.count + 1})
+
+
+def add_to_leaderboards(score):
+    """Counts a new score on its quiz's and subject's boards and histograms; the caller commits."""
+    db.session.flush()  # The entries refer to the score by id
+    question_count, subject_id = db.session.query(Quiz.question_count, Chapter.subject_id) \
+        .join(Chapter, Chapter.id == Quiz.chapter_id).filter(Quiz.id == score.quiz_id).one()
+    for scope, scope_id in (('quiz', score.quiz_id), ('subject', subject_id)):
+        value = score_value(scope, score.total_scored, question_count)
+        _count(scope, scope_id, bucket_of(value))
+        entry = {'score_id': score.id, 'user_id': score.user_id, 'value': value,
+                 'total_scored': score.total_scored, 'time_stamp_of_attempt': score.time_stamp_of_attempt}
+        for side in SIDES:
+            _offer(scope, scope_id, side, entry)
+
+
+def leaderboard(scope, scope_id, side='top', limit=None):
+    """The ranked entries of one board, best (or worst) first, with their users."""
+    size = app.config['LEADERBOARD_SIZE']
+    limit = min(limit, size) if limit and limit > 0 else size
+    return _board(scope, scope_id, side).options(db.joinedload(LeaderboardEntry.user)) \
+        .order_by(*_ranking(side)).limit(limit).all()
+
+
+def top_values(scope):
+    """The best value on every board of a scope, by scope id."""
+    return dict(db.session.query(LeaderboardEntry.scope_id, func.max(LeaderboardEntry.value))
+                .filter(LeaderboardEntry.scope == scope, LeaderboardEntry.side == 'top')
+                .group_by(LeaderboardEntry.scope_id).all())
+
+
+def attempt_total(scope, scope_id):
+    return db.session.query(func.coalesce(func.sum(ScoreHistogram.count), 0)) \
+        .filter_by(scope=scope, scope_id=scope_id).scalar()
+
+
+def percentile(scope, scope_id, value):
+    """Percentage of the board's attempts below value, counting its own bucket as half, read from
+    the histogram instead of sorting the scores. None if there are no attempts."""
+    bucket = bucket_of(value)
+    total, below, equal = db.session.query(
+        func.sum(ScoreHistogram.count),
+        func.sum(case((ScoreHistogram.bucket < bucket, ScoreHistogram.count), else_=0)),
+        func.sum(case((ScoreHistogram.bucket == bucket, ScoreHistogram.count), else_=0)),
+    ).filter_by(scope=scope, scope_id=scope_id).one()
+    if not total:
+        return None
+    return (below + equal / 2) * 100.0 / total
+
+
+def user_best(scope, scope_id, user_id):
+    """A user's best value on a board, from their per-quiz statistics. None if they have no attempts."""
+    if scope == 'quiz':
+        best = db.session.query(UserQuizStats.max_score) \
+            .filter_by(user_id=user_id, quiz_id=scope_id).scalar()
+        return None if best is None else float(best)
+    percentage = UserQuizStats.max_score * 100.0 / func.nullif(Quiz.question_count, 0)
+    return db.session.query(func.max(percentage)) \
+        .join(Quiz, Quiz.id == UserQuizStats.quiz_id) \
+        .join(Chapter, Chapter.id == Quiz.chapter_id) \
+        .filter(UserQuizStats.user_id == user_id, Chapter.subject_id == scope_id).scalar()
+
+
+def _rebuild_board(scope, scope_id):
+    LeaderboardEntry.query.filter_by(scope=scope, scope_id=scope_id).delete(synchronize_session=False)
+    ScoreHistogram.query.filter_by(scope=scope, scope_id=scope_id).delete(synchronize_session=False)
+
+    scores = db.session.query(Score).join(Quiz, Quiz.id == Score.quiz_id)
+    if scope == 'quiz':
+        scores = scores.filter(Score.quiz_id == scope_id)
+        value = Score.total_scored * 1.0
+    else:
+        scores = scores.join(Chapter, Chapter.id == Quiz.chapter_id).filter(Chapter.subject_id == scope_id)
+        value = func.coalesce(Score.total_scored * 100.0 / func.nullif(Quiz.question_count, 0), 0.0)
+
+    # Values are never negative, so truncating to an integer is the same as bucket_of()
+    bucket = db.cast(value, db.Integer)
+    db.session.execute(db.insert(ScoreHistogram).from_select(
+        ['scope', 'scope_id', 'bucket', 'count'],
+        scores.with_entities(db.literal(scope), db.literal(scope_id), bucket, func.count(Score.id)).group_by(bucket)))
+
+    for side in SIDES:
+        order = value.desc() if side == 'top' else value.asc()
+        rows = scores.with_entities(Score.id, Score.user_id, Score.total_scored, Score.time_stamp_of_attempt,
+                                    value.label('value')) \
+            .order_by(order, Score.time_stamp_of_attempt, Score.id).limit(app.config['LEADERBOARD_SIZE']).all()
+        if rows:
+            db.session.execute(db.insert(LeaderboardEntry), [
+                {'scope': scope, 'scope_id': scope_id, 'side': side, 'score_id': row.id, 'user_id': row.user_id,
+                 'value': row.value, 'total_scored': row.total_scored,
+                 'time_stamp_of_attempt': row.time_stamp_of_attempt}
+                for row in rows
+            ])
+
+
+def rebuild_leaderboards(quiz_ids=None):
+    """Recomputes the boards and histograms of the given quizzes and of their subjects (of everything
+    when None) from the Score table.
+
+    Subject percentages are taken against each quiz's current number of questions.
+    """
+    quizzes = db.session.query(Quiz.id, Chapter.subject_id).join(Chapter, Chapter.id == Quiz.chapter_id)
+    if quiz_ids is None:
+        LeaderboardEntry.query.delete(synchronize_session=False)
+        ScoreHistogram.query.delete(synchronize_session=False)
+    else:
+        quizzes = quizzes.filter(Quiz.id.in_(quiz_ids))
+    quizzes = quizzes.all()
+
+    for row in quizzes:
+        _rebuild_board('quiz', row.id)
+    for subject_id in sorted({row.subject_id for row in quizzes}):
+        _rebuild_board('subject', subject_id)
+    db.session.commit()
+    return len(quizzes)
+
+
+@app.cli.command('rebuild-leaderboards')
+@click.argument('quiz_ids', nargs=-1, type=int)
+def rebuild_leaderboards_command(quiz_ids):
+    """Rebuilds the leaderboards of the given quizzes and their subjects (all when none are given)."""
+    count = rebuild_leaderboards(list(quiz_ids) or None)
+    print(f'Rebuilt leaderboards of {count} quizzes and their subjects.')
@@ -0,0 +1,165 @@
+from sqlalchemy import inspect, text
+from app import app
+from models.models import db, Quiz, QuizAttempt, AttemptAnswer, SchemaVersion, \
+    UserQuizStats, UserWeeklyStats, LeaderboardEntry, ScoreHistogram, CacheGeneration
+
+
+def add_columns(conn, table, columns):
+    """Adds each (name, definition) column that the table does not have yet."""
+    existing = {column['name'] for column in inspect(conn).get_columns(table)}
+    for name, definition in columns:
+        if name not in existing:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {definition}'))
+
+
+def add_quiz_counters(conn):
+    """Adds the question and score counters to quiz and fills them in."""
+    columns = [
+        ('question_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('attempt_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('score_sum', 'INTEGER NOT NULL DEFAULT 0'),
+        ('max_score', 'INTEGER'),
+        ('min_score', 'INTEGER'),
+    ]
+    add_columns(conn, 'quiz', columns)
+
+
+def add_hot_path_indexes(conn):
+    """Creates the indexes for the hot query patterns."""
+    indexes = [
+        ('ix_chapter_subject_id', 'chapter', 'subject_id'),
+        ('ix_quiz_chapter_id', 'quiz', 'chapter_id'),
+        ('ix_question_quiz_id', 'question', 'quiz_id'),
+        ('ix_score_user_time', 'score', 'user_id, time_stamp_of_attempt'),
+        ('ix_score_quiz_total', 'score', 'quiz_id, total_scored'),
+    ]
+    for name, table, columns in indexes:
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+
+
+def create_attempt_tables(conn):
+    """Creates the tables of the database attempt store."""
+    QuizAttempt.__table__.create(bind=conn, checkfirst=True)
+    AttemptAnswer.__table__.create(bind=conn, checkfirst=True)
+
+
+def add_questions_version(conn):
+    """Adds the counter that invalidates cached answer keys."""
+    add_columns(conn, 'quiz', [('questions_version', 'INTEGER NOT NULL DEFAULT 0')])
+
+
+def add_score_answers(conn):
+    """Adds the packed per-answer column used for regrading."""
+    add_columns(conn, 'score', [('answers', db.LargeBinary().compile(dialect=conn.dialect))])
+
+
+def add_search_index(conn):
+    """Creates the full-text search index and fills it from the existing rows."""
+    from models.search import create_search_index, rebuild_search_index
+    if create_search_index(conn):
+        rebuild_search_index(conn)
+
+
+def create_user_stats_tables(conn):
+    """Creates the per-user statistics tables; upgrade() fills them afterwards."""
+    UserQuizStats.__table__.create(bind=conn, checkfirst=True)
+    UserWeeklyStats.__table__.create(bind=conn, checkfirst=True)
+
+
+def create_leaderboard_tables(conn):
+    """Creates the leaderboard and score histogram tables; upgrade() fills them afterwards."""
+    LeaderboardEntry.__table__.create(bind=conn, checkfirst=True)
+    ScoreHistogram.__table__.create(bind=conn, checkfirst=True)
+
+
+def create_cache_generation_table(conn):
+    """Creates the content generation counter used to invalidate cached pages."""
+    CacheGeneration.__table__.create(bind=conn, checkfirst=True)
+
+
+def add_score_ack_id(conn):
+    """Adds the acknowledgement id of queued scores, unique so that journal replays are idempotent."""
+    add_columns(conn, 'score', [('ack_id', 'VARCHAR(32)')])
+    conn.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_score_ack_id ON score (ack_id)'))
+
+
+def add_trigram_indexes(conn):
+    """Creates the trigram indexes that serve substring search on PostgreSQL; nothing elsewhere."""
+    from models.search import create_trigram_indexes
+    create_trigram_indexes(conn)
+
+
+def rekey_search_index(conn):
+    """Re-indexes every row under the rowid derived from its kind and id."""
+    from models.search import fts_available, rebuild_search_index
+    if fts_available(conn):
+        rebuild_search_index(conn)
+
+
+# Ordered list of (version, description, upgrade function)
+MIGRATIONS = [
+    (1, 'Add question and score counters to quiz', add_quiz_counters),
+    (2, 'Add indexes for hot query patterns', add_hot_path_indexes),
+    (3, 'Add quiz attempt store tables', create_attempt_tables),
+    (4, 'Add questions version to quiz', add_questions_version),
+    (5, 'Add packed answers to score', add_score_answers),
+    (6, 'Add full-text search index', add_search_index),
+    (7, 'Add per-user statistics tables', create_user_stats_tables),
+    (8, 'Add leaderboard tables', create_leaderboard_tables),
+    (9, 'Add cache generation counter', create_cache_generation_table),
+    (10, 'Add acknowledgement id to score', add_score_ack_id),
+    (11, 'Add trigram search indexes', add_trigram_indexes),
+    (12, 'Key search index rows by rowid', rekey_search_index),
+]
+
+HEAD = MIGRATIONS[-1][0]
+
+
+def current_version():
+    """Highest migration applied to the database, 0 if none."""
+    SchemaVersion.__table__.create(bind=db.engine, checkfirst=True)
+    return db.session.query(db.func.max(SchemaVersion.version)).scalar() or 0
+
+
+def upgrade():
+    """Applies every pending migration, each in its own transaction. Returns the versions applied."""
+    applied = []
+    version = current_version()
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        with db.engine.begin() as conn:
+            migrate(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(version=number, description=description))
+        applied.append(number)
+
+    # Counters added by migration 1 start at zero on existing data
+    if 1 in applied:
+        Quiz.rebuild_counters()
+    # So do the per-user statistics added by migration 7
+    if 7 in applied:
+        UserQuizStats.rebuild()
+        UserWeeklyStats.rebuild()
+    # And the leaderboards added by migration 8
+    if 8 in applied:
+        from models.leaderboard import rebuild_leaderboards
+        rebuild_leaderboards()
+    return applied
+
+
+def stamp(version=HEAD):
+    """Marks a freshly created schema as being at the given migration version."""
+    for number, description, migrate in MIGRATIONS:
+        if number <= version and not db.session.get(SchemaVersion, number):
+            db.session.add(SchemaVersion(version=number, description=description))
+    db.session.commit()
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Applies pending schema migrations."""
+    applied = upgrade()
+    if applied:
+        print(f'Applied migrations: {", ".join(map(str, applied))}. Schema is at version {HEAD}.')
+    else:
+        print(f'Schema is up to date (version {HEAD}).')
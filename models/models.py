@@ -1,9 +1,21 @@
 from datetime import datetime, date
 from app import app
+import click
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import case, func, or_, inspect
+from models import passwords
+from models.dialects import upsert
+from models.engine import (engine_options, sqlite_pragmas, install_pragmas, analytics_uri,
+                           RoutingSession, ANALYTICS_BIND)
 
-db=SQLAlchemy(app)
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+if analytics_uri(app.config):
+    app.config.setdefault('SQLALCHEMY_BINDS', {}).setdefault(
+        ANALYTICS_BIND, {'url': analytics_uri(app.config), **engine_options(app.config)})
+db=SQLAlchemy(app, session_options={'class_': RoutingSession})
+with app.app_context():
+    for _key, _engine in db.engines.items():
+        install_pragmas(_engine, sqlite_pragmas(app.config, read_only=_key == ANALYTICS_BIND))
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -20,10 +32,13 @@ class User(db.Model):
     
     @password.setter
     def password(self,password):
-        self.password_hash=generate_password_hash(password)
+        self.password_hash=passwords.hash_password(password)
 
     def verify_password(self,password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
     
     @staticmethod
     def parse_date(date_string):
@@ -40,23 +55,76 @@ class Subject(db.Model):
 
 class Chapter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False, index=True)
     name = db.Column(db.String(120), nullable=False)
     description = db.Column(db.Text)
     subject = db.relationship('Subject', backref=db.backref('chapters'))
 
 class Quiz(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=False)
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=False, index=True)
     title = db.Column(db.String(255))
     date_of_quiz = db.Column(db.Date)
     time_duration = db.Column(db.Time)
     remarks = db.Column(db.Text)
+    # Counters maintained by the routes that add questions and save scores
+    question_count = db.Column(db.Integer, nullable=False, default=0)
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+    max_score = db.Column(db.Integer)
+    min_score = db.Column(db.Integer)
+    # Bumped whenever a question is added, edited or deleted; cached answer keys compare against it
+    questions_version = db.Column(db.Integer, nullable=False, default=0)
     chapter = db.relationship('Chapter', backref=db.backref('quizzes'))
 
+    @property
+    def average_score(self):
+        return self.score_sum / self.attempt_count if self.attempt_count else None
+
+    @staticmethod
+    def change_question_count(quiz_id, delta):
+        """Adjusts the question counter in the current transaction; the caller commits."""
+        Quiz.query.filter_by(id=quiz_id).update({
+            Quiz.question_count: Quiz.question_count + delta,
+            Quiz.questions_version: Quiz.questions_version + 1,
+        })
+
+    @staticmethod
+    def questions_changed(quiz_id):
+        """Marks the quiz's questions as edited in the current transaction; the caller commits."""
+        Quiz.query.filter_by(id=quiz_id).update({Quiz.questions_version: Quiz.questions_version + 1})
+
+    @staticmethod
+    def record_attempt(quiz_id, total_scored):
+        """Adds one attempt to the score counters in the current transaction; the caller commits."""
+        Quiz.query.filter_by(id=quiz_id).update({
+            Quiz.attempt_count: Quiz.attempt_count + 1,
+            Quiz.score_sum: Quiz.score_sum + total_scored,
+            Quiz.max_score: case((or_(Quiz.max_score.is_(None), Quiz.max_score < total_scored), total_scored),
+                                 else_=Quiz.max_score),
+            Quiz.min_score: case((or_(Quiz.min_score.is_(None), Quiz.min_score > total_scored), total_scored),
+                                 else_=Quiz.min_score),
+        })
+
+    @staticmethod
+    def rebuild_counters(quiz_id=None):
+        """Recomputes the counters of every quiz, or of one quiz, from the Question and Score tables."""
+        question_counts = db.session.query(func.count(Question.id)) \
+            .filter(Question.quiz_id == Quiz.id).scalar_subquery()
+        scores = db.session.query(Score).filter(Score.quiz_id == Quiz.id)
+        quizzes = Quiz.query if quiz_id is None else Quiz.query.filter_by(id=quiz_id)
+        quizzes.update({
+            Quiz.question_count: question_counts,
+            Quiz.attempt_count: scores.with_entities(func.count(Score.id)).scalar_subquery(),
+            Quiz.score_sum: scores.with_entities(func.coalesce(func.sum(Score.total_scored), 0)).scalar_subquery(),
+            Quiz.max_score: scores.with_entities(func.max(Score.total_scored)).scalar_subquery(),
+            Quiz.min_score: scores.with_entities(func.min(Score.total_scored)).scalar_subquery(),
+        }, synchronize_session=False)
+        db.session.commit()
+
 class Question(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), nullable=False)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), nullable=False, index=True)
     question_statement = db.Column(db.Text, nullable=False)
     option1 = db.Column(db.String(255))
     option2 = db.Column(db.String(255))
@@ -66,41 +134,244 @@ class Question(db.Model):
     quiz = db.relationship('Quiz', backref=db.backref('questions'))
 
 class Score(db.Model):
+    __table_args__ = (
+        # A user's attempts in date order (scoreboard, user summary)
+        db.Index('ix_score_user_time', 'user_id', 'time_stamp_of_attempt'),
+        # A quiz's attempts and its top/bottom scores
+        db.Index('ix_score_quiz_total', 'quiz_id', 'total_scored'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     time_stamp_of_attempt = db.Column(db.DateTime)
     total_scored = db.Column(db.Integer)
+    # Selected options packed by models.grading.pack_answers, kept so scores can be regraded
+    answers = db.Column(db.LargeBinary)
+    # Acknowledgement id handed out when the score was queued (models/ingest.py)
+    ack_id = db.Column(db.String(32), unique=True)
     quiz = db.relationship('Quiz', backref=db.backref('scores'))
     user = db.relationship('User', backref=db.backref('scores'))
 
-#creating the table if it doesn't exist
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-    admin=User.query.filter_by(is_admin=True).first()
-    if not admin:
-        admin=User(username='admin',password='13121989',is_admin=True)
-        db.session.add(admin)
+class UserQuizStats(db.Model):
+    # Running totals of one user's attempts at one quiz, updated as scores are saved
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), primary_key=True)
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+    max_score = db.Column(db.Integer)
+    last_score = db.Column(db.Integer)
+    last_attempt_at = db.Column(db.DateTime)
+    quiz = db.relationship('Quiz')
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.attempt_count if self.attempt_count else None
+
+    @staticmethod
+    def record_attempt(user_id, quiz_id, total_scored, attempted_at):
+        """Adds one attempt to the user's totals for the quiz in the current transaction; the caller commits."""
+        upsert(db.session, UserQuizStats,
+               dict(user_id=user_id, quiz_id=quiz_id, attempt_count=1, score_sum=total_scored,
+                    max_score=total_scored, last_score=total_scored, last_attempt_at=attempted_at),
+               ['user_id', 'quiz_id'], {
+                   UserQuizStats.attempt_count: UserQuizStats.attempt_count + 1,
+                   UserQuizStats.score_sum: UserQuizStats.score_sum + total_scored,
+                   UserQuizStats.max_score: case((UserQuizStats.max_score < total_scored, total_scored),
+                                                 else_=func.coalesce(UserQuizStats.max_score, total_scored)),
+                   UserQuizStats.last_score: total_scored,
+                   UserQuizStats.last_attempt_at: attempted_at,
+               })
+
+    @staticmethod
+    def rebuild(user_ids=None, quiz_id=None):
+        """Recomputes the totals of every user, or of the given users, from the Score table; of
+        every quiz, or only of quiz_id."""
+        stats = UserQuizStats.query
+        scores = db.session.query(Score.user_id, Score.quiz_id)
+        if user_ids is not None:
+            stats = stats.filter(UserQuizStats.user_id.in_(user_ids))
+            scores = scores.filter(Score.user_id.in_(user_ids))
+        if quiz_id is not None:
+            stats = stats.filter(UserQuizStats.quiz_id == quiz_id)
+            scores = scores.filter(Score.quiz_id == quiz_id)
+        stats.delete(synchronize_session=False)
+
+        latest = db.aliased(Score)
+        last_score = db.session.query(latest.total_scored) \
+            .filter(latest.user_id == Score.user_id, latest.quiz_id == Score.quiz_id) \
+            .order_by(latest.time_stamp_of_attempt.desc(), latest.id.desc()).limit(1).scalar_subquery()
+        totals = scores.add_columns(func.count(Score.id), func.sum(Score.total_scored), func.max(Score.total_scored),
+                                    last_score, func.max(Score.time_stamp_of_attempt)) \
+            .group_by(Score.user_id, Score.quiz_id)
+        db.session.execute(db.insert(UserQuizStats).from_select(
+            ['user_id', 'quiz_id', 'attempt_count', 'score_sum', 'max_score', 'last_score', 'last_attempt_at'],
+            totals))
         db.session.commit()
 
-from sqlalchemy import inspect
-    
-'''# Creating the table if it doesn't exist
-with app.app_context():
-    # Check if the tables already exist
-    if not inspect(db.engine).get_table_names():
-        db.drop_all()
-        db.create_all()  # Only create tables if they don't exist
-    
-    # Ensure admin user exists
-    admin = User.query.filter_by(is_admin=True).first()
-    if not admin:
-        admin = User(username='admin', password='13121989', is_admin=True)
-        db.session.add(admin)
-        db.session.commit() '''
+class UserWeeklyStats(db.Model):
+    # Number and score total of one user's attempts in one week (Year-Week, as in week_of)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    week = db.Column(db.String(7), primary_key=True)
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.attempt_count if self.attempt_count else None
 
+    @staticmethod
+    def week_of(timestamp):
+        return timestamp.strftime('%Y-%W')
+
+    @staticmethod
+    def record_attempt(user_id, total_scored, attempted_at):
+        """Adds one attempt to the user's bucket for that week in the current transaction; the caller commits."""
+        week = UserWeeklyStats.week_of(attempted_at)
+        upsert(db.session, UserWeeklyStats,
+               dict(user_id=user_id, week=week, attempt_count=1, score_sum=total_scored),
+               ['user_id', 'week'], {
+                   UserWeeklyStats.attempt_count: UserWeeklyStats.attempt_count + 1,
+                   UserWeeklyStats.score_sum: UserWeeklyStats.score_sum + total_scored,
+               })
+
+    @staticmethod
+    def adjust(score_changes):
+        """Adds {(user_id, week): change in score total} to existing buckets in the current
+        transaction, after scores are regraded; the caller commits."""
+        if score_changes:
+            table = UserWeeklyStats.__table__
+            db.session.execute(
+                table.update().where(table.c.user_id == db.bindparam('b_user_id'), table.c.week == db.bindparam('b_week'))
+                .values(score_sum=table.c.score_sum + db.bindparam('b_change')),
+                [{'b_user_id': user_id, 'b_week': week, 'b_change': change}
+                 for (user_id, week), change in score_changes.items()])
+
+    @staticmethod
+    def rebuild(user_ids=None):
+        """Recomputes the weekly buckets of every user, or of the given users, from the Score table.
+
+        Weeks are bucketed in Python with week_of() so they match record_attempt() on any database.
+        """
+        stats = UserWeeklyStats.query
+        scores = db.session.query(Score.user_id, Score.time_stamp_of_attempt, Score.total_scored) \
+            .filter(Score.time_stamp_of_attempt.isnot(None))
+        if user_ids is not None:
+            stats = stats.filter(UserWeeklyStats.user_id.in_(user_ids))
+            scores = scores.filter(Score.user_id.in_(user_ids))
+        stats.delete(synchronize_session=False)
+
+        buckets = {}
+        for user_id, attempted_at, total_scored in scores.yield_per(1000):
+            bucket = buckets.setdefault((user_id, UserWeeklyStats.week_of(attempted_at)), [0, 0])
+            bucket[0] += 1
+            bucket[1] += total_scored or 0
+        if buckets:
+            db.session.execute(db.insert(UserWeeklyStats), [
+                {'user_id': user_id, 'week': week, 'attempt_count': count, 'score_sum': total}
+                for (user_id, week), (count, total) in buckets.items()
+            ])
+        db.session.commit()
+
+class LeaderboardEntry(db.Model):
+    # One of the best or worst attempts of a quiz or subject, kept by models/leaderboard.py
+    __table_args__ = (
+        db.Index('ix_leaderboard_entry_board', 'scope', 'scope_id', 'side', 'value'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(8), nullable=False)  # 'quiz' or 'subject'
+    scope_id = db.Column(db.Integer, nullable=False)
+    side = db.Column(db.String(6), nullable=False)  # 'top' or 'bottom'
+    score_id = db.Column(db.Integer, db.ForeignKey('score.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # What the board is ranked by: the score for a quiz, the percentage for a subject
+    value = db.Column(db.Float, nullable=False)
+    total_scored = db.Column(db.Integer)
+    time_stamp_of_attempt = db.Column(db.DateTime)
+    user = db.relationship('User')
+
+class ScoreHistogram(db.Model):
+    # Number of attempts of a quiz or subject per whole score (quiz) or whole percent (subject)
+    scope = db.Column(db.String(8), primary_key=True)
+    scope_id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class QuizAttempt(db.Model):
+    # In-progress attempt kept by the database attempt store (models/attempts.py)
+    __table_args__ = (
+        db.Index('ix_quiz_attempt_user_quiz', 'user_id', 'quiz_id'),
+    )
+    id = db.Column(db.String(32), primary_key=True)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    current_question_index = db.Column(db.Integer, nullable=False, default=0)
+    total_questions = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class AttemptAnswer(db.Model):
+    # One row per answered question, written as the user goes
+    attempt_id = db.Column(db.String(32), db.ForeignKey('quiz_attempt.id'), primary_key=True)
+    question_id = db.Column(db.Integer, primary_key=True)
+    selected_option = db.Column(db.Integer, nullable=False)
+
+class CacheGeneration(db.Model):
+    # Counter bumped in the same transaction as every content change (subjects, chapters,
+    # quizzes, questions); cached pages built under an older generation are dropped
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
 
+    @staticmethod
+    def current(name='content'):
+        return db.session.query(CacheGeneration.value).filter_by(name=name).scalar() or 0
+
+    @staticmethod
+    def bump(name='content'):
+        """Advances the generation in the current transaction; the caller commits."""
+        upsert(db.session, CacheGeneration, dict(name=name, value=1), ['name'],
+               {CacheGeneration.value: CacheGeneration.value + 1})
+
+class SchemaVersion(db.Model):
+    # One row per migration applied by models/migrations.py
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(255))
+    applied_at = db.Column(db.DateTime, default=datetime.now)
+
+# Schema setup is an explicit step (flask init-db / flask seed-admin) so that
+# importing the app does no DDL and every worker starts quickly
+@app.cli.command('init-db')
+def init_db_command():
+    """Creates missing tables and applies pending migrations. Safe to run repeatedly."""
+    from models.migrations import stamp, upgrade
+    fresh = not inspect(db.engine).get_table_names()
+    db.create_all(bind_key=None)  # The analytics engine is read-only
+    if fresh:
+        stamp()
+        print('Database created.')
+    else:
+        applied = upgrade()
+        print(f'Applied migrations: {", ".join(map(str, applied))}.' if applied else 'Database is up to date.')
+
+@app.cli.command('seed-admin')
+@click.option('--username', default='admin', help='Username of the admin account.')
+@click.option('--password', default='13121989', envvar='ADMIN_PASSWORD', help='Password of the admin account.')
+def seed_admin_command(username, password):
+    """Creates the admin account unless an admin already exists."""
+    admin=User.query.filter_by(is_admin=True).first()
+    if admin:
+        print(f'Admin already exists: {admin.username}')
+        return
+    admin=User(username=username,password=password,is_admin=True)
+    db.session.add(admin)
+    db.session.commit()
+    print(f'Admin created: {username}')
 
+@app.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """Rebuilds the denormalized question and score counters on every quiz and the per-user statistics."""
+    Quiz.rebuild_counters()
+    UserQuizStats.rebuild()
+    UserWeeklyStats.rebuild()
+    print('Quiz counters and user statistics rebuilt.')
 
-        
+# Registers the upgrade-db command
+from models import migrations
@@ -0,0 +1,92 @@
+import base64
+import json
+from collections import namedtuple
+from datetime import date, datetime, time
+
+from flask import request
+from sqlalchemy import and_, or_
+
+from app import app
+
+# One page of a keyset-paginated listing. The cursors are opaque strings for the
+# 'after'/'before' query parameters, or None when there is nothing in that direction.
+Page = namedtuple('Page', 'items next_cursor prev_cursor')
+
+
+def encode_cursor(values):
+    payload = [value.isoformat() if isinstance(value, (date, datetime, time)) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Reads a cursor back into values of the key columns' types; None if it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        decoded = []
+        for value, column in zip(values, columns):
+            python_type = column.type.python_type
+            if value is not None and python_type in (date, datetime, time):
+                value = python_type.fromisoformat(value)
+            decoded.append(value)
+        return decoded
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def _beyond(columns, values, greater):
+    """Rows whose (columns...) key is strictly greater (or smaller) than the given values."""
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        clauses.append(and_(*equal, column > values[i] if greater else column < values[i]))
+    # The redundant bound on the leading column lets the database seek the index to the cursor
+    leading = columns[0] >= values[0] if greater else columns[0] <= values[0]
+    return and_(leading, or_(*clauses))
+
+
+def _key(item, columns):
+    return [getattr(item, column.key) for column in columns]
+
+
+def page_size():
+    """The page size asked for with ?per_page=, within the configured limit."""
+    per_page = request.args.get('per_page', app.config['PAGE_SIZE'], type=int)
+    return min(max(per_page, 1), app.config['MAX_PAGE_SIZE'])
+
+
+def keyset_paginate(query, columns, per_page=None, after=None, before=None, descending=False):
+    """Returns one page of a query ordered by unique key columns, e.g. (Score.time_stamp_of_attempt, Score.id).
+
+    Instead of OFFSET, the page starts right after (or ends right before) the key of a row
+    from the neighbouring page, so every page costs the same however deep it is.
+    after/before default to the request's query parameters.
+    """
+    per_page = per_page or page_size()
+    if after is None and before is None:
+        after = request.args.get('after')
+        before = request.args.get('before')
+
+    backwards = before is not None and after is None
+    cursor = decode_cursor(before if backwards else after, columns) if (after or before) else None
+
+    # Walking backwards reads the index in reverse and flips the page afterwards
+    ascending = descending == backwards
+    if cursor is not None:
+        query = query.filter(_beyond(columns, cursor, ascending))
+    order = [column.asc() if ascending else column.desc() for column in columns]
+    items = query.order_by(*order).limit(per_page + 1).all()
+
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    if not items:
+        return Page(items, None, None)
+    has_next = has_more if not backwards else True
+    has_prev = has_more if backwards else cursor is not None
+    return Page(items,
+                encode_cursor(_key(items[-1], columns)) if has_next else None,
+                encode_cursor(_key(items[0], columns)) if has_prev else None)
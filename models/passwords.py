@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app import app
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Hashing jobs submitted to the pool and not finished yet
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+class PasswordQueueFull(Exception):
+    """Raised when PASSWORD_QUEUE_LIMIT hashing jobs are already waiting; ask the user to retry."""
+
+
+def _hash(password, method, salt_length):
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+def _get_executor():
+    global _executor
+    workers = app.config['PASSWORD_WORKERS']
+    if not workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+
+def _run(fn, *args):
+    """Runs a hashing function in the worker pool so it does not hold up the request threads,
+    or inline when PASSWORD_WORKERS is 0."""
+    global _in_flight
+    executor = _get_executor()
+    if executor is None:
+        return fn(*args)
+
+    with _in_flight_lock:
+        if _in_flight >= app.config['PASSWORD_QUEUE_LIMIT']:
+            raise PasswordQueueFull()
+        _in_flight += 1
+    try:
+        return executor.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A worker died; drop the pool so the next call starts a fresh one
+        _reset_executor()
+        return fn(*args)
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+
+
+def hash_password(password):
+    """Hashes a password with the configured PASSWORD_HASH_METHOD."""
+    return _run(_hash, password, app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+@lru_cache(maxsize=8)
+def _method_prefix(method):
+    """The parameters werkzeug writes in front of hashes made with method, with its defaults filled in."""
+    return generate_password_hash('', method=method, salt_length=1).split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    """Whether a stored hash was made with other parameters than the configured ones."""
+    return password_hash.split('$', 1)[0] != _method_prefix(app.config['PASSWORD_HASH_METHOD'])
@@ -0,0 +1,120 @@
+import threading
+
+import click
+
+from app import app
+from models.models import db, Quiz, Score, UserQuizStats, UserWeeklyStats
+from models.grading import answer_key
+from models.leaderboard import rebuild_leaderboards
+
+
+def regrade_quiz(quiz_id, chunk_size=None):
+    """Recomputes total_scored of every attempt at a quiz from the stored answers.
+
+    Scores are read in primary-key chunks and changed ones written back with one batched
+    UPDATE per chunk, each chunk in its own short transaction, so memory stays bounded and
+    the database is never locked for long. If the questions change again meanwhile (any edit
+    bumps questions_version, not only the ones that start a regrade) it starts over from the
+    first chunk with the new answer key, so no attempt is left graded against an old one.
+    Returns (attempts regraded, scores changed, attempts without stored answers).
+    """
+    chunk_size = chunk_size or app.config['REGRADE_CHUNK_SIZE']
+    version = db.session.query(Quiz.questions_version).filter(Quiz.id == quiz_id).scalar()
+    if version is None:
+        return 0, 0, 0
+    key = answer_key(quiz_id, version)
+
+    regraded = changed = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Score.id, Score.user_id, Score.time_stamp_of_attempt, Score.answers,
+                                Score.total_scored) \
+            .filter(Score.quiz_id == quiz_id, Score.answers.isnot(None), Score.id > last_id) \
+            .order_by(Score.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        new_scores = key.grade_matrix(key.packed_matrix([row.answers for row in rows]))
+        changed_rows = [(row, int(new_score)) for row, new_score in zip(rows, new_scores)
+                        if row.total_scored != new_score]
+        if changed_rows:
+            db.session.execute(db.update(Score), [{'id': row.id, 'total_scored': new_score}
+                                                  for row, new_score in changed_rows])
+            # The statistics of the users whose scores changed, in the chunk's transaction
+            weekly_changes = {}
+            for row, new_score in changed_rows:
+                if row.time_stamp_of_attempt is not None:
+                    bucket = (row.user_id, UserWeeklyStats.week_of(row.time_stamp_of_attempt))
+                    weekly_changes[bucket] = weekly_changes.get(bucket, 0) + new_score - (row.total_scored or 0)
+            UserWeeklyStats.adjust(weekly_changes)
+            UserQuizStats.rebuild({row.user_id for row, _ in changed_rows}, quiz_id)  # Commits
+        else:
+            db.session.commit()
+        regraded += len(rows)
+        changed += len(changed_rows)
+
+        current = db.session.query(Quiz.questions_version).filter(Quiz.id == quiz_id).scalar()
+        if current is None:
+            break  # The quiz was deleted
+        if current != version:
+            version = current
+            key = answer_key(quiz_id, version)
+            last_id = 0
+
+    if changed:
+        Quiz.rebuild_counters(quiz_id)
+        rebuild_leaderboards([quiz_id])
+    missing = Score.query.filter(Score.quiz_id == quiz_id, Score.answers.is_(None)).count()
+    return regraded, changed, missing
+
+
+# Regrades running in this process: quiz id -> [thread, another pass requested]
+_regrades = {}
+_regrades_lock = threading.Lock()
+
+
+def start_regrade(quiz_id):
+    """Runs regrade_quiz in a background thread so the request that triggered it returns at once.
+
+    While a regrade of the quiz is running, further requests only ask it for one more pass once
+    it is done, so several quick edits cost at most two passes rather than one each.
+    """
+    with _regrades_lock:
+        running = _regrades.get(quiz_id)
+        if running is not None:
+            running[1] = True
+            return running[0]
+        state = [None, False]
+
+        def run():
+            with app.app_context():
+                while True:
+                    try:
+                        regrade_quiz(quiz_id)
+                    except Exception:
+                        app.logger.exception('Regrading quiz %s failed', quiz_id)
+                    db.session.remove()
+                    with _regrades_lock:
+                        if not state[1]:
+                            del _regrades[quiz_id]
+                            return
+                        state[1] = False
+
+        state[0] = threading.Thread(target=run, name=f'regrade-quiz-{quiz_id}', daemon=True)
+        _regrades[quiz_id] = state
+        state[0].start()
+        return state[0]
+
+
+@app.cli.command('regrade')
+@click.argument('quiz_ids', nargs=-1, type=int)
+@click.option('--chunk-size', type=int, default=None, help='Scores read and updated per transaction.')
+def regrade_command(quiz_ids, chunk_size):
+    """Regrades stored attempts of the given quizzes (all quizzes when none are given)."""
+    if not quiz_ids:
+        quiz_ids = [row.id for row in db.session.query(Quiz.id).order_by(Quiz.id)]
+    for quiz_id in quiz_ids:
+        regraded, changed, missing = regrade_quiz(quiz_id, chunk_size)
+        print(f'Quiz {quiz_id}: {regraded} attempts regraded, {changed} scores changed, '
+              f'{missing} attempts without stored answers.')
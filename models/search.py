@@ -0,0 +1,195 @@
+import re
+from collections import namedtuple
+
+from sqlalchemy import event, inspect, text, or_
+
+from app import app
+from models.models import db, User, Subject, Chapter, Quiz, Question
+
+# What gets indexed for each searchable kind: model and a function returning (title, body),
+# or None for rows that must not show up in search
+SEARCHABLE = {
+    'users': (User, lambda user: None if user.is_admin else (user.username, user.full_name)),
+    'subjects': (Subject, lambda subject: (subject.name, subject.description)),
+    'chapters': (Chapter, lambda chapter: (chapter.name, chapter.description)),
+    'quizzes': (Quiz, lambda quiz: (quiz.title, quiz.remarks)),
+    'questions': (Question, lambda question: (question.question_statement, None)),
+}
+
+# Index rows are keyed by rowid = ref_id * 8 + the kind's number, so replacing or removing one is
+# a rowid lookup rather than a scan of the unindexed kind and ref_id columns. Add new kinds at the end.
+KIND_NUMBERS = {kind: number for number, kind in enumerate(SEARCHABLE, start=1)}
+
+# Substring fallback for databases without FTS5 (trigram indexed on PostgreSQL): the columns
+# matched for each kind
+FALLBACK_COLUMNS = {
+    'users': (User.username, User.full_name),
+    'subjects': (Subject.name, Subject.description),
+    'chapters': (Chapter.name, Chapter.description),
+    'quizzes': (Quiz.title, Quiz.remarks),
+    'questions': (Question.question_statement,),
+}
+
+SearchPage = namedtuple('SearchPage', 'items page has_prev has_next')
+
+_fts_available = {}
+
+
+def fts_available(conn):
+    """Whether this database has the search_index FTS5 table (checked once per engine)."""
+    engine = conn.engine
+    if engine not in _fts_available:
+        _fts_available[engine] = conn.dialect.name == 'sqlite' and inspect(conn).has_table('search_index')
+    return _fts_available[engine]
+
+
+def create_trigram_indexes(conn):
+    """Creates pg_trgm GIN indexes on the substring search columns, which PostgreSQL uses for
+    their ILIKE '%...%' matches. Returns whether they exist; needs the right to create the extension."""
+    if conn.dialect.name != 'postgresql':
+        return False
+    try:
+        with conn.begin_nested():  # A failure must not abort the surrounding transaction
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            for columns in FALLBACK_COLUMNS.values():
+                for column in columns:
+                    table = column.property.columns[0].table.name
+                    conn.execute(text(
+                        f'CREATE INDEX IF NOT EXISTS ix_trgm_{table}_{column.key} '
+                        f'ON "{table}" USING gin ({column.key} gin_trgm_ops)'))
+    except Exception:
+        app.logger.warning('Could not create the pg_trgm indexes; substring search scans the tables')
+        return False
+    return True
+
+
+def create_search_index(conn):
+    """Creates the FTS5 table on SQLite builds that support it, or the trigram indexes on
+    PostgreSQL. Returns whether the FTS5 table exists."""
+    _fts_available.pop(conn.engine, None)
+    if conn.dialect.name != 'sqlite':
+        create_trigram_indexes(conn)
+        return False
+    try:
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "kind UNINDEXED, ref_id UNINDEXED, title, body, tokenize='unicode61 remove_diacritics 2')"))
+    except Exception:
+        app.logger.warning('SQLite was built without FTS5; search falls back to substring matching')
+        return False
+    return True
+
+
+_INSERT = text('INSERT INTO search_index (rowid, kind, ref_id, title, body) '
+               'VALUES (:rowid, :kind, :ref_id, :title, :body)')
+_DELETE = text('DELETE FROM search_index WHERE rowid = :rowid')
+
+
+def index_rowid(kind, ref_id):
+    return ref_id * 8 + KIND_NUMBERS[kind]
+
+
+def index_documents(conn, kind, documents):
+    """Adds (ref_id, title, body) rows of one kind to the index in one executemany, for rows
+    written without the ORM events below (bulk inserts)."""
+    if not fts_available(conn) or not documents:
+        return 0
+    conn.execute(_INSERT, [{'rowid': index_rowid(kind, ref_id), 'kind': kind, 'ref_id': ref_id,
+                            'title': title, 'body': body} for ref_id, title, body in documents])
+    return len(documents)
+
+
+def rebuild_search_index(conn):
+    """Re-indexes every searchable row."""
+    if not fts_available(conn):
+        return 0
+    conn.execute(text('DELETE FROM search_index'))
+    total = 0
+    for kind, (model, document) in SEARCHABLE.items():
+        batch = []
+        for row in conn.execute(db.select(model.__table__)):
+            fields = document(row)
+            if fields:
+                batch.append((row.id, *fields))
+            if len(batch) >= 1000:
+                total += index_documents(conn, kind, batch)
+                batch = []
+        total += index_documents(conn, kind, batch)
+    return total
+
+
+# Keep the index in step with the tables, inside the same transaction as the change
+def _index_row(kind, document, replace=True):
+    def listener(mapper, conn, target):
+        if not fts_available(conn):
+            return
+        rowid = index_rowid(kind, target.id)
+        if replace:
+            conn.execute(_DELETE, {'rowid': rowid})
+        fields = document(target)
+        if fields:
+            conn.execute(_INSERT, {'rowid': rowid, 'kind': kind, 'ref_id': target.id,
+                                   'title': fields[0], 'body': fields[1]})
+    return listener
+
+
+def _unindex_row(kind):
+    def listener(mapper, conn, target):
+        if fts_available(conn):
+            conn.execute(_DELETE, {'rowid': index_rowid(kind, target.id)})
+    return listener
+
+
+for _kind, (_model, _document) in SEARCHABLE.items():
+    event.listen(_model, 'after_insert', _index_row(_kind, _document, replace=False))
+    event.listen(_model, 'after_update', _index_row(_kind, _document))
+    event.listen(_model, 'after_delete', _unindex_row(_kind))
+
+# create_all() also creates the search index
+event.listen(db.metadata, 'after_create', lambda target, conn, **kw: create_search_index(conn))
+
+
+def match_expression(query):
+    """Turns free text into an FTS5 query: every word must match, as a prefix."""
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search(kind, query, page=1, per_page=20):
+    """Finds rows of one kind, best matches first, one page at a time.
+
+    An empty query lists every row of that kind.
+    """
+    model = SEARCHABLE[kind][0]
+    offset = (page - 1) * per_page
+    expression = match_expression(query)
+
+    if not expression:
+        rows = model.query
+        if model is User:
+            rows = rows.filter(User.is_admin == False)
+        items = rows.order_by(model.id).offset(offset).limit(per_page + 1).all()
+    elif fts_available(db.session.connection()):
+        ids = [row.ref_id for row in db.session.execute(text(
+            'SELECT ref_id FROM search_index WHERE search_index MATCH :expression AND kind = :kind '
+            'ORDER BY bm25(search_index, 0, 0, 10.0, 1.0) LIMIT :limit OFFSET :offset'),
+            {'expression': expression, 'kind': kind, 'limit': per_page + 1, 'offset': offset})]
+        by_id = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+        items = [by_id[ref_id] for ref_id in ids if ref_id in by_id]
+    else:
+        columns = FALLBACK_COLUMNS[kind]
+        rows = model.query.filter(or_(*[column.ilike(f'%{query}%') for column in columns]))
+        if model is User:
+            rows = rows.filter(User.is_admin == False)
+        items = rows.order_by(model.id).offset(offset).limit(per_page + 1).all()
+
+    return SearchPage(items[:per_page], page, page > 1, len(items) > per_page)
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Recreates the full-text search index from the tables."""
+    with db.engine.begin() as conn:
+        create_search_index(conn)
+        total = rebuild_search_index(conn)
+    print(f'Indexed {total} rows.')